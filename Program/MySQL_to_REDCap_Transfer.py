@@ -1,63 +1,132 @@
+import hashlib
+import json
 import logging
+import requests
+from async_redcap import AsyncREDCap
+from contextlib import nullcontext
+from datetime import datetime
+from mysql.connector.constants import FieldType
+from mysql_pool import execute_prepared
+from project_schema import load_schema
+from redcap import RedcapError
+from transfer_metrics import TransferMetrics
 logging.captureWarnings(True)
 
 
 # MARK: Database Info
 
+# Number of rows read from mysql and imported to REDCap in one API call
+IMPORT_CHUNK_SIZE = 500
+
+# Control table keeping a digest of each row last imported to each form of each REDCap project
+DIGEST_TABLE = 'redcap_push_digest'
+
+# Number of digests written to the control table in one INSERT
+DIGEST_BATCH_SIZE = 1000
+
+# Read rows as the bytes mysql sends instead of converting them to Python types, then to text again for REDCap
+RAW_ROWS = True
+
+# Formats REDCap imports dates and datetimes in, by text validation without its display order
+redcap_date_formats = {'date': '%Y-%m-%d', 'datetime': '%Y-%m-%d %H:%M', 'datetime_seconds': '%Y-%m-%d %H:%M:%S'}
+
 
 # MARK: Database Functions
-# To import one record from mysql to REDCap, change to correct format
-def import_record(columns, values):
+# Function turning a mysql row into a record REDCap imports, with one converter per column picked from the column's type
+def compile_row_decoder(description, columns, formats=None, raw=False):
     """
-    :param columns: columns names of mysql table
-    :param values: values for a mysql row
-    :return: dictionary mapping variable to data
+    :param description: curs.description of the query the rows come from
+    :param columns: names the record's values are imported as, in the order of the row, separated by commas
+    :param formats: optional format of each column's dates, from date_formats
+    :param raw: whether rows come from a raw cursor, every value then being the bytes mysql sent
+    :return: function mapping a row to a dictionary of variable to value, NULL is imported as blank
     """
-    # Each record will be a dictionary (within a list), mapping variable to data
-    response = {}
 
-    if len(columns.split(",")) != len(values):  # Make sure columns and values are equal length
-        print("Error: Column length: " + str(len(columns.split(","))) + ", value length: " + str(len(values)))
-    else:
-        # Go through values to be added and add to dictionary
-        for i in range(len(columns.split(","))):
-            if values[i] == 'None':
-                values[i] = ''
-            elif 'bytearray' in str(values[i]):
-                temp = str(values[i]).split("'")
-                values[i] = temp[1]
-            response[columns.split(",")[i].strip()] = values[i]
+    names = [name.strip() for name in columns.split(",")]
+    if len(names) != len(description):
+        raise ValueError("Column length: " + str(len(names)) + ", value length: " + str(len(description)))
+
+    converters = []
+    for index, column in enumerate(description):
+        date_format = formats[index] if formats else None
+        if raw:
+            # Mysql sends dates as Y-M-D text, the formats REDCap imports are the first part of it
+            length = len(datetime(2000, 1, 1).strftime(date_format)) if date_format else None
+            converters.append(lambda value, length=length: '' if value is None else value.decode('utf-8')[:length])
+        elif column[1] in [FieldType.DATE, FieldType.NEWDATE] + FieldType.get_timestamp_types():
+            converters.append(lambda value, date_format=date_format: '' if value is None else
+                              value.strftime(date_format) if date_format else str(value))
+        elif column[1] in FieldType.get_string_types() + FieldType.get_binary_types():
+            converters.append(lambda value: '' if value is None else
+                              value.decode('utf-8') if isinstance(value, (bytes, bytearray)) else value)
+        elif column[1] in [FieldType.DECIMAL, FieldType.NEWDECIMAL, FieldType.TIME]:
+            converters.append(lambda value: '' if value is None else str(value))
+        else:
+            converters.append(lambda value: '' if value is None else value)
 
-    return response
+    def decode(row):
+        return dict(zip(names, [convert(value) for convert, value in zip(converters, row)]))
+    return decode
 
 
-# MARK: API Functions
+# Format of each variable's dates, None for variables that are not dates
+def date_formats(schema, variables):
+    formats = []
+    for var in variables:
+        validation = str(schema.field(var).get('text_validation_type_or_show_slider_number') or '')
+        formats.append(redcap_date_formats.get(validation.rsplit("_", 1)[0]))
+    return formats
 
-# Get variables of REDCap project in the order the are in the project
-def get_variable_order(meta, form):
-    var_order = []
-
-    # Go through each variable and add to list
-    for detail in meta:
-        if detail['form_name'] == form:
-            # If checkbox, only one field but multiple variables
-            if detail['field_type'] == "checkbox":
-                for i in range(len(detail['select_choices_or_calculations'].split("|"))):
-                    new_var = detail['field_name'] + "___" + str(i + 1)
-                    var_order.append(new_var)
-            else:
-                var_order.append(detail['field_name'])
 
-    if var_order[0] == 'study_id':
-        return var_order
-    else:
-        var_order.insert(0, 'study_id')
-        return var_order
+# Stable hash of a record as it is imported, changes whenever its key or any of its values do
+def row_digest(record):
+    return hashlib.sha1(json.dumps(record, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+# Get the digest of each row last imported to a form of REDCap project, creating the control table if needed
+def get_digests(curs, project_id, form):
+    """
+    :param curs: cursor for database
+    :param project_id: name identifying the REDCap project
+    :param form: REDCap form the rows were imported to
+    :return: dictionary mapping record ID to digest
+    """
 
+    curs.execute("CREATE TABLE IF NOT EXISTS `" + DIGEST_TABLE + "` (`project` varchar(255) NOT NULL, "
+                 "`form` varchar(64) NOT NULL, `record` varchar(255) NOT NULL, `digest` char(40) NOT NULL, "
+                 "PRIMARY KEY (`project`, `form`, `record`)) ENGINE=InnoDB")
+    curs.execute("SELECT `record`, `digest` FROM `" + DIGEST_TABLE + "` WHERE `project` = %s AND `form` = %s",
+                 (project_id, form))
+    return dict(curs.fetchall())
+
+
+# Record the digests of rows imported to a form of REDCap project, and forget those of deleted rows
+def set_digests(data, curs, project_id, form, digests, deleted=()):
+    rows = [(project_id, form, record, digest) for record, digest in digests.items()]
+    for start in range(0, len(rows), DIGEST_BATCH_SIZE):
+        curs.executemany("INSERT INTO `" + DIGEST_TABLE + "` (`project`, `form`, `record`, `digest`) "
+                         "VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE `digest` = VALUES(`digest`)",
+                         rows[start:start + DIGEST_BATCH_SIZE])
+    # DELETE is sent a row at a time, so it is prepared once and only the values are sent for each record
+    deleted = [(project_id, form, record) for record in deleted]
+    if len(deleted) > 0:
+        execute_prepared(data, "DELETE FROM `" + DIGEST_TABLE + "` WHERE `project` = %s AND `form` = %s "
+                         "AND `record` = %s", deleted, many=True)
+    data.commit()
+
+
+# MARK: API Functions
 
 # MARK: Actions
 
-def check_for_errors(redcap_vars, mysql_vars):
+def check_for_errors(redcap_vars, mysql_vars, rename=None):
+    """
+    :param redcap_vars: variables of REDCap form in order
+    :param mysql_vars: columns of mysql table in order
+    :param rename: whether mismatched columns are renamed to the REDCap variables, None asks
+    :return: column names to import with, separated by commas
+    """
+
     temp = list(mysql_vars).copy()
     bad_vars = list()
     errors = False
@@ -88,17 +157,17 @@ def check_for_errors(redcap_vars, mysql_vars):
         for i in range(0, len(bad_vars), 2):
             print("" + bad_vars[i] + " --> " + bad_vars[i + 1] + "")
         change = ''
+        if rename is not None:
+            change = 'y' if rename else 'n'
         while not (change == 'y' or change == 'n'):
-            y = 'y'
-            n = 'n'
             change = input("\nWould you like to make the variable changes? y/n\n")
-            if change == 'y':
-                for i in range(len(mysql_vars)):
-                    if mysql_vars[i] in bad_vars:
-                        temp[i] = redcap_vars[i]
-                print("\n----\n")
-            else:
-                errors = True
+        if change == 'y':
+            for i in range(len(mysql_vars)):
+                if mysql_vars[i] in bad_vars:
+                    temp[i] = redcap_vars[i]
+            print("\n----\n")
+        else:
+            errors = True
 
     # If any errors, can't complete transfer
     if errors:
@@ -106,41 +175,127 @@ def check_for_errors(redcap_vars, mysql_vars):
     return ", ".join(temp)
 
 
-def execute(curs, table, form, redcap):
+def execute(curs, table, form, redcap, schema, chunk_size=IMPORT_CHUNK_SIZE, rename=None, metrics=None,
+            previous=None, current=None, concurrency=1, raw=False):
     """
-    :param curs: cursor for mysql database
+    :param curs: unbuffered cursor for mysql database, rows are streamed from the server
     :param table: name of mysql table being transferred
     :param form: REDCap form being imported to
     :param redcap: REDCap project being imported to
-    :return:
+    :param schema: compiled schema of REDCap project
+    :param chunk_size: number of rows imported to REDCap in one API call
+    :param rename: whether mismatched columns are renamed to the REDCap variables, None asks
+    :param metrics: optional TransferMetrics the time spent reading, decoding and importing is added to
+    :param previous: if given, dictionary mapping record ID to the digest of the row last imported, only rows that
+        are new or changed are imported
+    :param current: dictionary filled with the digest of every row now in REDCap, needed with previous
+    :param concurrency: number of chunks imported to REDCap at once, more than 1 needs aiohttp
+    :param raw: whether curs is a raw cursor, giving the bytes mysql sends for each value
+    :return: number of records imported
     """
 
+    if metrics is None:
+        metrics = TransferMetrics()
+
     # Load the MySQL table that is being transferred
     query_all = "SELECT * FROM "
     query_all += str(table)
     curs.execute(query_all)
 
     # Load MySQL variables and REDCap variables
-    variables = get_variable_order(redcap.metadata, form)
+    variables = schema.form_variables[form]
     # Make sure the columns in MySQL and REDCap match before proceeding
-    mysql_column_names = check_for_errors(variables, curs.column_names)
-
-    # List of new records, which will be individual dictionaries
-    new_records = []
-    print("Gathering records from '" + str(table) + "'")
-
-    # For each row in database, get into correct format, add to list
-    for line in curs:
-        new_line = []
-        for j in range(len(variables)):
-            new_line.append(line[j])
-        response = import_record(mysql_column_names, new_line)
-        new_records.append(response)
-
-    # Import records to REDCap
-    print("Importing records to '" + str(form) + "'")
-    print(redcap.import_records(new_records))
+    mysql_column_names = check_for_errors(variables, curs.column_names, rename)
+
+    # Dates read from DATE and DATETIME columns are imported in the format of their REDCap validation
+    decode = compile_row_decoder(curs.description, mysql_column_names, date_formats(schema, variables), raw)
+
+    print("Importing records from '" + str(table) + "' to '" + str(form) + "'")
+    imported = 0
+    failed = 0
+    unchanged = 0
+    chunk_num = 0
+
+    # Import chunks to REDCap together, each as (chunk number, records, digests of the records)
+    def push(client, pending):
+        nonlocal imported, failed
+
+        with metrics.timer('import', table):
+            if client is None:
+                results = []
+                for _, new_records, _ in pending:
+                    try:
+                        results.append(redcap.import_records(new_records) if len(new_records) > 0 else None)
+                    except (RedcapError, requests.RequestException) as err:
+                        results.append(err)
+            else:
+                futures = [client.submit(client.import_records(new_records)) if len(new_records) > 0 else None
+                           for _, new_records, _ in pending]
+                results = []
+                for future in futures:
+                    try:
+                        results.append(None if future is None else future.result())
+                    except RedcapError as err:
+                        results.append(err)
+
+        # A failed chunk is reported and the rest of the table is still imported
+        for (number, new_records, digests), result in zip(pending, results):
+            if not isinstance(result, Exception):
+                imported += len(new_records)
+                metrics.add('rows', len(new_records), table)
+                if previous is not None:
+                    current.update(digests)
+                continue
+
+            print("Chunk " + str(number) + " failed: " + str(result))
+            failed += len(new_records)
+            metrics.add('rows_failed', len(new_records), table)
+            # Rows that failed keep the digest of what REDCap still has
+            for record_id in digests:
+                if record_id in previous:
+                    current[record_id] = previous[record_id]
+
+    # Read rows a chunk at a time, get each into correct format, and import the chunks to REDCap a few at a time
+    with AsyncREDCap(redcap, concurrency) if concurrency > 1 else nullcontext() as client:
+        pending = []
+        with metrics.timer('read', table):
+            lines = curs.fetchmany(chunk_size)
+        while len(lines) > 0:
+            chunk_num += 1
+            with metrics.timer('transform', table):
+                new_records = [decode(line) for line in lines]
+
+                # Rows whose digest is the same as last time are already in REDCap and are left out
+                digests = dict()
+                if previous is not None:
+                    sending = []
+                    for record in new_records:
+                        record_id = str(record[schema.key])
+                        digest = row_digest(record)
+                        if previous.get(record_id) == digest:
+                            current[record_id] = digest
+                        else:
+                            digests[record_id] = digest
+                            sending.append(record)
+                    unchanged += len(new_records) - len(sending)
+                    metrics.add('rows_unchanged', len(new_records) - len(sending), table)
+                    new_records = sending
+
+            pending.append((chunk_num, new_records, digests))
+            if len(pending) >= concurrency:
+                push(client, pending)
+                pending = []
+                metrics.progress(table, imported + failed + unchanged)
+
+            with metrics.timer('read', table):
+                lines = curs.fetchmany(chunk_size)
+
+        push(client, pending)
+
+    print("Imported " + str(imported) + " records, " + str(failed) + " failed" +
+          ("" if previous is None else ", " + str(unchanged) + " unchanged"))
     print("Done")
+    return imported
 
 
 def get_table(tables):
@@ -161,40 +316,88 @@ def get_form(forms, table):
     return form
 
 
-def transfer(mysql_database_name, redcap_project_name):
+def transfer(mysql_database_name, redcap_project_name, chunk_size=IMPORT_CHUNK_SIZE, transfers=None, rename=None,
+             metrics=None, changed_only=False, report_deleted=False, concurrency=1):
     """
-    mysql_database_name = mysql database
+    mysql_database_name = mysql database, opened without buffered=True so rows are streamed
     redcap_project_name = REDCap project
+    chunk_size = number of rows imported to REDCap in one API call
+    transfers = list of (table, form) to transfer without asking, None asks
+    rename = whether mismatched columns are renamed to the REDCap variables, None asks
+    metrics = optional TransferMetrics the time and throughput of each stage and table are recorded in
+    changed_only = if True, only rows new or changed since the last run are imported
+    report_deleted = if True with changed_only, rows imported before that are no longer in the table are listed
+    concurrency = number of chunks imported to REDCap at once, more than 1 needs aiohttp
+    returns dictionary mapping each table transferred to the number of records imported
     """
 
-    curs = mysql_database_name.cursor()
+    if metrics is None:
+        metrics = TransferMetrics(redcap_project_name.name or '')
+    metrics.activate()
+
+    curs = mysql_database_name.cursor(buffered=True)
+    with metrics.timer('metadata'):
+        schema = load_schema(redcap_project_name)
     curs.execute("SHOW TABLES")
 
     tables = list()
     [tables.append(name) for (name,) in curs]
-    if len(tables) > 1:
+
+    # Ask which tables go to which forms, unless they are given
+    if transfers is not None:
+        for table, form in transfers:
+            if table not in tables:
+                raise ValueError("Did not find table '" + str(table) + "'")
+            if form not in schema.forms:
+                raise ValueError("Did not find form '" + str(form) + "'")
+    elif len(tables) > 1:
         num_transfers = ''
         num_transfers = input("How many tables would you like to transfer?\n")
         while not num_transfers.isdigit():
             num_transfers = input("Please enter number of transfers.\n")
         num_transfers = int(num_transfers)
 
-        if num_transfers == 1:
-            table = get_table(tables)
-            form = get_form(redcap_project_name.forms, table)
-            execute(curs, table, form, redcap_project_name)
-        else:
-            export_tables = []
-            import_forms = []
-            for i in range(num_transfers):
+        transfers = []
+        for i in range(num_transfers):
+            if num_transfers > 1:
                 print("\nTransfer " + str(i + 1) + ":")
-                table = get_table(tables)
-                export_tables.append(table)
-                import_forms.append(get_form(redcap_project_name.forms, table))
-
-            for i in range(num_transfers):
-                execute(curs, export_tables[i], import_forms[i], redcap_project_name)
+            table = get_table(tables)
+            transfers.append((table, get_form(schema.forms, table)))
     else:
-        execute(curs, tables[0], redcap_project_name.forms[0], redcap_project_name)
-
+        transfers = [(tables[0], schema.forms[0])]
+
+    # Rows of the tables being transferred are streamed from the server instead of held in memory
+    stream = mysql_database_name.cursor(buffered=False, raw=RAW_ROWS)
+    # Under the C extension a connection opened with buffered=True gives a buffered cursor whatever is asked for,
+    # which would read the whole table into memory
+    if 'Buffered' in type(stream).__name__:
+        stream.close()
+        curs.close()
+        raise ValueError("MySQL connection must be opened without buffered=True so rows are streamed")
+    imported = dict()
+    project_id = redcap_project_name.name or redcap_project_name.url
+    for table, form in transfers:
+        if not changed_only:
+            imported[table] = execute(stream, table, form, redcap_project_name, schema, chunk_size, rename, metrics,
+                                      concurrency=concurrency, raw=RAW_ROWS)
+            continue
+
+        # Digests are read before and written after the table is streamed, the connection is busy in between
+        previous = get_digests(curs, project_id, form)
+        current = dict()
+        imported[table] = execute(stream, table, form, redcap_project_name, schema, chunk_size, rename, metrics,
+                                  previous, current, concurrency, RAW_ROWS)
+
+        deleted = [record for record in previous if record not in current]
+        set_digests(mysql_database_name, curs, project_id, form,
+                    dict((record, digest) for record, digest in current.items() if previous.get(record) != digest),
+                    deleted)
+        if report_deleted and len(deleted) > 0:
+            metrics.add('rows_deleted', len(deleted), table)
+            print(str(len(deleted)) + " records imported before are no longer in '" + str(table) + "': " +
+                  ", ".join(deleted))
+
+    stream.close()
     curs.close()
+    metrics.finish()
+    return imported
@@ -1,264 +1,724 @@
+import async_redcap
+import csv
+import export_cache
+import file_fields
+import json
 import mysql.connector
-import sys
+import os
+import re
+from mysql_pool import execute_prepared
+from project_schema import load_schema
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from io import StringIO
+from operator import itemgetter
+from transfer_metrics import TransferMetrics
 import logging
 logging.captureWarnings(True)
 
+try:
+    import numpy
+    import pandas
+except ImportError:
+    pandas = None
+
 # Dictionary mapping REDCap data types to MySQL data types
-mysql_field_type = {'text': 'varchar', 'notes': 'varchar', 'dropdown': 'varchar',
-                    'radio': 'varchar', 'checkbox': 'varchar', 'file': '', 'calc': '',
-                    'sql': '', 'descriptive': '', 'slider': 'int',
+mysql_field_type = {'text': 'varchar', 'notes': 'text', 'dropdown': 'varchar',
+                    'radio': 'varchar', 'checkbox': 'varchar', 'file': 'varchar', 'calc': 'double',
+                    'sql': 'varchar', 'slider': 'int',
                     'yesno': 'varchar', 'truefalse': 'varchar'}
 
+# Dictionary mapping REDCap text validation types to MySQL data types, REDCap exports every date as Y-M-D. The min and
+# max of a validation are only a warning in REDCap, so integers are not given a smaller type from them
+mysql_validation_type = {'integer': 'bigint', 'number': 'double',
+                         'number_1dp': 'decimal(20,1)', 'number_2dp': 'decimal(20,2)',
+                         'number_3dp': 'decimal(20,3)', 'number_4dp': 'decimal(20,4)',
+                         'date_ymd': 'date', 'date_mdy': 'date', 'date_dmy': 'date',
+                         'datetime_ymd': 'datetime', 'datetime_mdy': 'datetime', 'datetime_dmy': 'datetime',
+                         'datetime_seconds_ymd': 'datetime', 'datetime_seconds_mdy': 'datetime',
+                         'datetime_seconds_dmy': 'datetime',
+                         'time': 'varchar(5)', 'time_mm_ss': 'varchar(5)', 'zipcode': 'varchar(10)',
+                         'phone': 'varchar(50)', 'email': 'varchar(255)'}
+
+# Most bytes the columns of a row may take, MySQL refuses a table whose VARCHAR columns could take more. A utf8mb4
+# VARCHAR takes 4 bytes a character, TEXT only the pointer to its value
+MAX_ROW_BYTES = 65535
+TEXT_BYTES = 12
+
+# Bytes a row takes for column types of a fixed size
+fixed_type_bytes = {'tinyint': 1, 'smallint': 2, 'mediumint': 3, 'int': 4, 'bigint': 8, 'double': 8, 'decimal': 10,
+                    'date': 3, 'datetime': 8}
+
+# Shortest varchar of label columns, leaving room for codes that are no longer choices and are kept as they are
+LABEL_MIN_LENGTH = 32
+
+# Number of rows sent to mysql in one INSERT and committed together
+INSERT_BATCH_SIZE = 1000
+
+# Ways of writing rows to mysql: batched INSERT statements, or LOAD DATA LOCAL INFILE from a spool file
+LOAD_STRATEGIES = ['insert', 'infile']
+
+# Errors meaning the client or server does not allow LOAD DATA LOCAL INFILE
+infile_refused = [1148, 2068, 3948]
+
+# Errors caused by the values of a row rather than the table or connection, besides SQLSTATE classes 22 and 23.
+# The connector raises some of them, such as 1265 and 1366, as DatabaseError rather than DataError
+row_errors = [1048, 1062, 1264, 1265, 1292, 1366, 1406, 1452, 3819]
+
+# Escapes of special characters in a spool file for LOAD DATA INFILE
+infile_escapes = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+# Ways of decoding records: a dictionary per record decoded cell by cell, or a DataFrame decoded column by column
+TRANSFORMS = ['rows', 'dataframe']
+
+# How a DataFrame export is read, every value kept as the same string the JSON export has
+frame_read_args = {'dtype': str, 'keep_default_na': False}
+
+# Control table keeping when each form of each REDCap project was last synced
+WATERMARK_TABLE = 'redcap_sync_watermark'
+
+# Seconds taken off the time a sync starts before it is kept as the watermark. REDCap compares dateRangeBegin with
+# the server's local time, so the margin has to cover how far this host's clock may run ahead of the server's, time
+# zones included. Records changed within the margin are exported again and upserted
+WATERMARK_MARGIN = 24 * 60 * 60
+
+# Control table keeping the last record committed to each table of a transfer that has not finished
+CHECKPOINT_TABLE = 'redcap_sync_checkpoint'
+
+# Suffixes of a table being built to replace a form's table, and of the table it replaced, kept until the next swap
+SHADOW_SUFFIX = '__new'
+OLD_SUFFIX = '__old'
+
+# Rows mysql rejects are appended to this file, one JSON object per line, and the transfer carries on
+REJECT_LOG = 'rejected_rows.jsonl'
+reject_lock = threading.Lock()
+
 # MARK: Database Functions
 
 
-# Insert a row, or multiple rows, into mysql
-def insert_index(data, curs, table, values, meta, var_order):
+# Insert a batch of rows into mysql
+def insert_rows(data, curs, table, rows, var_order, upsert=False, metrics=None, project_id=None):
     """
-    data = database being used
-    curs = cursor for database
-    table = name of mysql table being added to
-    values = string of values being added, separated by '///'
-    meta = metadata from REDCap project
-    var_order = order of variables in REDCap project of current form
+    :param data: database being used
+    :param curs: cursor for database
+    :param table: name of mysql table being added to
+    :param rows: list of tuples of values, each tuple in the same order as var_order
+    :param var_order: order of variables in REDCap project of current form
+    :param upsert: whether rows whose primary key is already in the table replace the existing row
+    :param metrics: optional TransferMetrics the bytes sent are counted in
+    :param project_id: if given, the last row's record is committed with the batch as the table's checkpoint
     """
 
-    # Make sure columns and values are equal length
-    if len(values.split("///")) == len(var_order):
-        new_values = []
-        var_index = 0
-        metadata_index = 0
+    if len(rows) == 0:
+        return
+
+    # Parameterized query, the connector sends the whole batch as one multi-row INSERT
+    insert = ("INSERT INTO `" + table + "` (" + ", ".join("`" + var + "`" for var in var_order) +
+              ") VALUES (" + ", ".join(["%s"] * len(var_order)) + ")")
+    if upsert:
+        # A table of only the primary key has nothing to update, the key is set to itself
+        insert += (" ON DUPLICATE KEY UPDATE " +
+                   ", ".join("`" + var + "` = VALUES(`" + var + "`)" for var in var_order[1:] or var_order[:1]))
+
+    # Execute insert query, commit once for the whole batch
+    try:
+        curs.executemany(insert, rows)
+        if metrics is not None:
+            metrics.add('bytes_written', len(getattr(curs, 'statement', None) or ''), table_form(table))
+    except mysql.connector.Error as err:
+        if not is_row_error(err):
+            raise
+        # Insert the batch again a row at a time with one prepared statement, rejected rows go to the reject log
+        data.rollback()
+        for row in rows:
+            try:
+                execute_prepared(data, insert, row)
+            except mysql.connector.Error as err:
+                if not is_row_error(err):
+                    raise
+                reject_row(table, row, err)
+                if metrics is not None:
+                    metrics.add('rows_rejected', 1, table_form(table))
+
+    if project_id is not None:
+        set_checkpoint(data, project_id, table, rows[-1][0])
+    data.commit()
+
+
+# Whether mysql refused a row for its values, so the row is rejected and the transfer carries on
+def is_row_error(err):
+    return err.errno in row_errors or str(err.sqlstate or '')[:2] in ['22', '23']
+
+
+# Append a row mysql rejected to the reject log
+def reject_row(table, row, err):
+    with reject_lock:
+        with open(REJECT_LOG, 'a') as log:
+            log.write(json.dumps({'time': datetime.now().isoformat(), 'table': table, 'error': str(err),
+                                  'row': list(row)}, default=str) + "\n")
+    print("Rejected record '" + str(row[0]) + "' of '" + str(table) + "', see " + REJECT_LOG + ": " + str(err))
+
+
+# Load rows into mysql with LOAD DATA LOCAL INFILE, returns False if the client or server does not allow it
+def load_rows(data, curs, table, rows, var_order, upsert=False, metrics=None, project_id=None):
+    """
+    :param data: database being used
+    :param curs: cursor for database
+    :param table: name of mysql table being added to
+    :param rows: list of tuples of values, each tuple in the same order as var_order
+    :param var_order: order of variables in REDCap project of current form
+    :param upsert: whether rows whose primary key is already in the table replace the existing row
+    :param metrics: optional TransferMetrics the bytes loaded are counted in
+    :param project_id: if given, the last row's record is committed with the load as the table's checkpoint
+    :return: True if the rows were loaded
+    """
 
-        # Go through REDCap metadata and load into query for mysql
-        while var_index < len(values.split("///")):
-            # What will follow 'VALUES'
-            var_type = meta[metadata_index]['field_type']
+    if len(rows) == 0:
+        return True
+
+    # Spool rows to a tab separated file, NULL is written as \N
+    spool = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix='.tsv', delete=False)
+    with spool:
+        for row in rows:
+            spool.write("\t".join("\\N" if value is None else str(value).translate(infile_escapes)
+                                  for value in row) + "\n")
+
+    load = ("LOAD DATA LOCAL INFILE '" + spool.name.replace("\\", "/") + "' " + ("REPLACE " if upsert else "") +
+            "INTO TABLE `" + table + "` CHARACTER SET utf8mb4 FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' "
+            "LINES TERMINATED BY '\\n' (" + ", ".join("`" + var + "`" for var in var_order) + ")")
+
+    # Secondary indexes are added once the whole table is written, see add_indexes
+    try:
+        curs.execute(load)
+        # LOAD DATA LOCAL ignores values that do not fit and only warns, a batch with warnings is inserted again with
+        # INSERT, which sends the rows at fault to the reject log instead of keeping the values mysql made of them
+        warnings = curs.warning_count
+        if warnings > 0:
+            data.rollback()
+            if metrics is not None:
+                metrics.add('load_warnings', warnings, table_form(table))
+            insert_rows(data, curs, table, rows, var_order, upsert, metrics, project_id)
+            return True
+        if project_id is not None:
+            set_checkpoint(data, project_id, table, rows[-1][0])
+        data.commit()
+        if metrics is not None:
+            metrics.add('bytes_written', os.path.getsize(spool.name), table_form(table))
+    except mysql.connector.Error as err:
+        if err.errno not in infile_refused:
+            raise
+        data.rollback()
+        print("LOAD DATA LOCAL INFILE is not allowed, using INSERT instead: " + str(err))
+        return False
+    finally:
+        os.remove(spool.name)
+
+    return True
+
+
+# Get when each form of REDCap project was last synced, creating the control table if needed
+def get_watermarks(curs, project_id):
+    """
+    :param curs: cursor for database
+    :param project_id: name identifying the REDCap project
+    :return: dictionary mapping form to the datetime it was last synced
+    """
 
-            # Go through values and change to correct mysql format
-            if mysql_field_type.get(var_type) == 'varchar':
-                new_str = '"' + str(values.split('///')[var_index]) + '"'
-                if len(new_str) == 0:
-                    new_str = 'null'
-                var_index += 1
+    curs.execute("CREATE TABLE IF NOT EXISTS `" + WATERMARK_TABLE + "` (`project` varchar(255) NOT NULL, "
+                 "`form` varchar(64) NOT NULL, `last_sync` datetime NOT NULL, "
+                 "PRIMARY KEY (`project`, `form`)) ENGINE=InnoDB")
+    curs.execute("SELECT `form`, `last_sync` FROM `" + WATERMARK_TABLE + "` WHERE `project` = %s", (project_id,))
+    return dict(curs.fetchall())
 
-            else:
-                new_str = str(values.split('///')[var_index])
-                var_index += 1
 
-            metadata_index += 1
-            new_values.append(new_str)
+# Record when a form of REDCap project was last synced
+def set_watermark(data, project_id, form, last_sync):
+    execute_prepared(data, "INSERT INTO `" + WATERMARK_TABLE + "` (`project`, `form`, `last_sync`) VALUES (%s, %s, %s) "
+                     "ON DUPLICATE KEY UPDATE `last_sync` = VALUES(`last_sync`)", (project_id, form, last_sync))
+    data.commit()
 
-        # Add new values back into query
-        new_values = ", ".join(new_values)
-        insert = ("INSERT INTO `" + table + "`(" + ", ".join(var_order) + ") VALUES(" + str(new_values) + ")")
 
-        # Execute insert query
-        try:
-            curs.execute(insert)
-            data.commit()
-        except mysql.connector.IntegrityError as err:
-            print(err)
-            print(insert)
-            exit(0)
+# Get the last record committed to each table of an unfinished transfer, creating the control table if needed
+def get_checkpoints(curs, project_id):
+    """
+    :param curs: cursor for database
+    :param project_id: name identifying the REDCap project
+    :return: dictionary mapping form to the last record committed to its table, '' if none was
+    """
 
-    else:
-        print("Values entered does not equal the number of columns")
+    curs.execute("CREATE TABLE IF NOT EXISTS `" + CHECKPOINT_TABLE + "` (`project` varchar(255) NOT NULL, "
+                 "`form` varchar(64) NOT NULL, `record` varchar(255) NOT NULL, "
+                 "PRIMARY KEY (`project`, `form`)) ENGINE=InnoDB")
+    curs.execute("SELECT `form`, `record` FROM `" + CHECKPOINT_TABLE + "` WHERE `project` = %s", (project_id,))
+    return dict(curs.fetchall())
+
+
+# Record the last record committed to a table, it is committed together with the rows
+def set_checkpoint(data, project_id, form, record):
+    execute_prepared(data, "INSERT INTO `" + CHECKPOINT_TABLE + "` (`project`, `form`, `record`) VALUES (%s, %s, %s) "
+                     "ON DUPLICATE KEY UPDATE `record` = VALUES(`record`)", (project_id, form, str(record)))
+
+
+# Forget the checkpoint of a table once every record is written to it
+def clear_checkpoint(data, curs, project_id, form):
+    curs.execute("DELETE FROM `" + CHECKPOINT_TABLE + "` WHERE `project` = %s AND `form` = %s", (project_id, form))
+    data.commit()
+
+
+# Records of a CSV export, one tuple of values per record in the order of the export's columns, so the variable names
+# are held once for the batch instead of once in every record
+class RecordBatch:
+    __slots__ = ['variables', 'positions', 'rows']
+
+    def __init__(self, variables, rows, positions=None):
+        """
+        :param variables: variables of the records, in the order of each row's values
+        :param rows: list of tuples of values
+        :param positions: dictionary mapping each variable to its position in a row, worked out if None
+        """
+
+        self.variables = variables
+        self.positions = positions or dict((var, position) for position, var in enumerate(variables))
+        self.rows = rows
+
+    @classmethod
+    def from_csv(cls, text):
+        reader = csv.reader(StringIO(text))
+        variables = next(reader, [])
+        return cls(variables, [tuple(row) for row in reader])
+
+    def __len__(self):
+        return len(self.rows)
+
+    # Records from a slice of the batch, the values themselves are shared with this batch
+    def __getitem__(self, positions):
+        return RecordBatch(self.variables, self.rows[positions], self.positions)
+
+    # Every value of one variable
+    def column(self, var):
+        if len(self.rows) == 0:
+            return []
+        position = self.positions[var]
+        return [row[position] for row in self.rows]
+
+    # Values of some variables of each record in the order given, picked from the rows as they are read
+    def project(self, variables):
+        pick = itemgetter(*[self.positions[var] for var in variables])
+        if len(variables) == 1:
+            return ((pick(row),) for row in self.rows)
+        return map(pick, self.rows)
+
+
+# Records exported as CSV text are read into a RecordBatch, other formats are kept as they are
+def read_records(records):
+    return RecordBatch.from_csv(records) if isinstance(records, str) else records
+
+
+# Labels of a radio or dropdown field, a code without a label is kept as it is
+class ChoiceLabels(dict):
+    def __missing__(self, code):
+        return code
+
+
+# Labels of a checkbox, yesno or truefalse field, anything but '1' is the off label
+class BinaryLabels(dict):
+    def __init__(self, on, off):
+        super().__init__({'1': on})
+        self.off = off
+
+    def __missing__(self, code):
+        return self.off
+
+
+# Fixed labels of REDCap data types with only two states
+binary_labels = {'checkbox': ("Checked (1)", "Unchecked (0)"),
+                 'truefalse': ("True (1)", "False (0)"),
+                 'yesno': ("Yes (1)", "No (0)")}
+
+
+# Compile the labels of every column of a form once, so each cell is decoded with one dict lookup
+def compile_decoder(schema, var_order):
+    """
+    :param schema: compiled schema of REDCap project
+    :param var_order: order of variables in REDCap project of current form
+    :return: list of (variable, labels) in the order of var_order, labels is None if the value is kept as is
+    """
+
+    decoder = []
+    for var in var_order:
+        detail = schema.field(var)
+        field_type = str(detail['field_type'])
+
+        if field_type == 'radio' or field_type == 'dropdown':
+            labels = ChoiceLabels()
+            for option in str(detail['select_choices_or_calculations']).split("|"):
+                option = option.split(",")
+                code = option[0].strip()
+                labels[code] = "".join(option[1:]).strip() + " (" + code + ")"
+        elif field_type in binary_labels:
+            labels = BinaryLabels(*binary_labels[field_type])
+        elif not is_text_type(column_type(schema, var)):
+            # Columns whose MySQL type is not text take NULL instead of an empty string
+            labels = ChoiceLabels({'': None})
+        else:
+            labels = None
+
+        decoder.append((var, labels))
+
+    return decoder
+
+
+# Decode the columns of a form from a DataFrame export, giving the same values as compile_decoder's labels
+def decode_columns(frame, decoder):
+    """
+    :param frame: records from REDCap project, exported as a DataFrame of strings
+    :param decoder: labels of the form's variables, from compile_decoder
+    :return: list of column values, one list per variable, in the order of decoder
+    """
+
+    columns = []
+    for var, labels in decoder:
+        values = frame[var].to_numpy(dtype=object)
+
+        if isinstance(labels, BinaryLabels):
+            values = numpy.where(values == '1', labels['1'], labels.off)
+        elif labels is not None:
+            # Look every code up at once, codes without a label are kept as they are
+            codes = pandas.Index(list(labels), dtype=object).get_indexer(values)
+            decoded = numpy.array(list(labels.values()) + [None], dtype=object)[codes]
+            values = numpy.where(codes >= 0, decoded, values)
+
+        columns.append(values.tolist())
+
+    return columns
+
+
+# Rows of a DataFrame export decoded a batch of records at a time, so only one batch is ever copied out of the frame
+def frame_rows(frame, decoder, batch_size=INSERT_BATCH_SIZE):
+    for start in range(0, len(frame), batch_size):
+        yield from zip(*decode_columns(frame.iloc[start:start + batch_size], decoder))
 
 
 # Insert entire database
-def add_all_indices(data, curs, table, meta, records, var_order, key, meta_index):
+def add_all_indices(data, curs, table, records, var_order, key, decoder, batch_size=INSERT_BATCH_SIZE,
+                    show_progress=True, upsert=False, load_strategy='insert', metrics=None, skip=0, project_id=None):
     """
     :param data: database being used
     :param curs: cursor for database
     :param table: name of mysql table being added to
-    :param meta: metadata from REDCap project
-    :param records: records from REDCap project
+    :param records: records from REDCap project, a RecordBatch, a list of dictionaries or a DataFrame
     :param var_order: order of variables in REDCap project of current form
     :param key: primary key of REDCap project
-    :param meta_index: dictionary of variables mapped to their metadata index
-    :return:
+    :param decoder: labels of the form's variables, from compile_decoder
+    :param batch_size: number of rows sent and committed together
+    :param show_progress: whether to display the rows written so far
+    :param upsert: whether records already in the table are updated instead of rejected
+    :param load_strategy: 'insert' for batched INSERT statements, 'infile' to load all rows with LOAD DATA
+    :param metrics: TransferMetrics the time spent decoding and writing the rows is added to
+    :param skip: number of records at the start of records that are already written
+    :param project_id: if given, the last record of each batch committed is saved as the table's checkpoint
+    :return: number of rows written
     """
 
-    # Helper function for displaying progress of transfer
-    def display_progress(percent_done, by_every, symbol):
-        num_spaces = 10
-        if percent_done < 10:
-            num_spaces = num_spaces
-        elif 9 < percent_done < 99:
-            num_spaces -= 1
-        else:
-            num_spaces -= 2
-        sys.stdout.write("\r" + str(percent_done) + "%" + (" " * num_spaces) + "[" +
-                         str(symbol * int(percent_done / by_every)) +
-                         (" " * (int(100 / by_every) - int(percent_done / by_every))) + "]")
-    # Info for displaying progress
-    max_index = int(records[len(records) - 1][key])
-    percentages = set(range(0, 101))
-
-    curs.execute("SELECT * FROM " + table)
-
-    # REDCap data types that do not translate exactly to MySQL
-    exceptions = ['radio', 'checkbox', 'dropdown', 'yesno', 'truefalse']
-
-    # Loop through each record
-    for record_num in range(len(records)):
-        # Turn tuple record into string
-        for var in var_order:
-            field_type = str(meta[meta_index.get(var)]['field_type'])
-
-            # If field type is in the exceptions, change data slightly
-            if field_type in exceptions:
-                choice = records[record_num][var]
-
-                if field_type == 'radio' or field_type == 'dropdown':
-                    choices = str(meta[meta_index.get(var)]['select_choices_or_calculations']).split("|")
-                    for option in choices:
-                        option = option.split(",")
-                        if field_type == 'radio' or field_type == 'dropdown':
-                            if option[0].strip() == str(choice):
-                                description = "".join(c for c in option[1:])
-                                description = description.strip() + " (" + str(choice) + ")"
-                                records[record_num][var] = description
-                elif field_type == 'checkbox':
-                    if choice == '1':
-                        records[record_num][var] = "Checked (1)"
-                    else:
-                        records[record_num][var] = "Unchecked (0)"
-                elif field_type == 'truefalse':
-                    if choice == '1':
-                        records[record_num][var] = "True (1)"
-                    else:
-                        records[record_num][var] = "False (0)"
-                elif field_type == 'yesno':
-                    if choice == '1':
-                        records[record_num][var] = "Yes (1)"
-                    else:
-                        records[record_num][var] = "No (0)"
+    if skip > 0:
+        records = records.iloc[skip:] if pandas is not None and isinstance(records, pandas.DataFrame) else \
+            records[skip:]
+    if len(records) == 0:
+        return 0
+    if metrics is None:
+        metrics = TransferMetrics()
+
+    # Time spent decoding is what is left of the whole loop once writing to mysql is taken out
+    target = table_form(table)
+    start = time.perf_counter()
+    written = metrics.seconds.get(('write', target), 0)
+
+    batch = []
+    done = 0
+
+    # Turn each record into a row of values in the order of the table's columns, decoding labels
+    if pandas is not None and isinstance(records, pandas.DataFrame):
+        rows = frame_rows(records, decoder, batch_size)
+    elif isinstance(records, RecordBatch):
+        rows = (tuple(value if labels is None else labels[value] for value, (_, labels) in zip(values, decoder))
+                for values in records.project([var for var, _ in decoder]))
+    else:
+        rows = (tuple(record[var] if labels is None else labels[record[var]] for var, labels in decoder)
+                for record in records)
+
+    # Loop through each row
+    for row in rows:
+        batch.append(row)
+
+        # Insert rows into table once the batch is full
+        if len(batch) >= batch_size and load_strategy == 'insert':
+            with metrics.timer('write', target):
+                insert_rows(data, curs, table, batch, var_order, upsert, metrics, project_id)
+            metrics.add('rows', len(batch), target)
+            done += len(batch)
+            batch = []
+
+            if show_progress:
+                metrics.progress(target, done, len(records))
+
+    # Load all rows at once with LOAD DATA, unless it is not allowed
+    with metrics.timer('write', target):
+        loaded = load_strategy == 'infile' and load_rows(data, curs, table, batch, var_order, upsert, metrics,
+                                                         project_id)
+
+        # Insert what is left of the last batch, or every row if LOAD DATA was not allowed
+        if not loaded:
+            for start_row in range(0, len(batch), batch_size):
+                insert_rows(data, curs, table, batch[start_row:start_row + batch_size], var_order, upsert, metrics,
+                            project_id)
+    metrics.add('rows', len(batch), target)
+
+    metrics.add_time('transform', time.perf_counter() - start - (metrics.seconds[('write', target)] - written), target)
+    if show_progress:
+        metrics.progress(target, len(records), len(records))
+
+    return len(records)
 
-        # Turn each row of data into string to be inserted into a MySQL query
-        row_info = "///".join(records[record_num][var] for var in var_order)
-        # Insert index into table
-        insert_index(data, curs, table, row_info, meta, var_order)
 
-        # Show progress
-        index = int(row_info.split("///")[0])
-        progress = int(round(index / max_index, 2) * 100)
-        if progress in percentages:
-            display_progress(progress, 5, "*")
-            percentages.remove(progress)
+# Longest label a radio, dropdown, checkbox, yesno or truefalse column holds
+def label_length(field):
+    if field['field_type'] in binary_labels:
+        return max(len(label) for label in binary_labels[field['field_type']])
+
+    longest = 0
+    for option in str(field['select_choices_or_calculations']).split("|"):
+        option = option.split(",")
+        longest = max(longest, len("".join(option[1:]).strip() + " (" + option[0].strip() + ")"))
+    return longest
+
+
+# MySQL column type of a REDCap variable, from its field type and text validation
+def column_type(schema, var):
+    """
+    :param schema: compiled schema of REDCap project
+    :param var: variable of REDCap project
+    :return: MySQL column type, such as 'varchar(255)', 'bigint' or 'date'
+    """
+
+    field = schema.field(var)
+    field_type = schema.field_types[var]
+    validation = str(field.get('text_validation_type_or_show_slider_number') or '')
+
+    if field_type == 'text' and validation in mysql_validation_type:
+        return mysql_validation_type[validation]
+    if field_type in ['radio', 'dropdown'] or field_type in binary_labels:
+        return "varchar(" + str(max(label_length(field), LABEL_MIN_LENGTH)) + ")"
+
+    base_type = mysql_field_type.get(field_type, 'varchar')
+    return "varchar(255)" if base_type == 'varchar' else base_type
+
+
+# Bytes a column of a MySQL type takes towards the largest row MySQL allows
+def column_bytes(mysql_type):
+    length = re.match(r'varchar\((\d+)\)', mysql_type)
+    if length:
+        return int(length.group(1)) * 4 + (1 if int(length.group(1)) * 4 < 256 else 2)
+    if mysql_type == 'text':
+        return TEXT_BYTES
+    return fixed_type_bytes.get(re.match(r'\w+', mysql_type).group(0), 8)
+
+
+# MySQL column types of the variables of a table, the widest VARCHAR columns are made TEXT until a row fits
+def table_column_types(schema, variables):
+    """
+    :param schema: compiled schema of REDCap project
+    :param variables: variables of the table, the primary key is an INT column
+    :return: dictionary mapping each variable but the primary key to its MySQL column type
+    """
+
+    types = dict((var, column_type(schema, var)) for var in variables if var != schema.key)
+    # Each nullable column also takes a bit
+    row_bytes = fixed_type_bytes['int'] + sum(column_bytes(mysql_type) for mysql_type in types.values()) + \
+        len(types) // 8 + 1
+    for var in sorted([var for var in types if types[var].startswith('varchar')],
+                      key=lambda var: column_bytes(types[var]), reverse=True):
+        if row_bytes <= MAX_ROW_BYTES:
+            break
+        row_bytes -= column_bytes(types[var]) - TEXT_BYTES
+        types[var] = 'text'
+    return types
+
+
+# Whether a MySQL column type holds text, other columns take NULL instead of an empty string
+def is_text_type(mysql_type):
+    return mysql_type.startswith('varchar') or mysql_type == 'text'
 
 
 # Create a mysql table
-def create_table(curs, tbl_name, variables, key, meta, meta_index):
+def create_table(curs, tbl_name, variables, schema, indexes=()):
     """
     curs = cursor for database
     tbl_name = name of table in mysql being created
     variables =  variables in REDCap project
-    key = primary key of REDCap project
-    meta = metadata of REDCap project
-    meta_index = dictionary mapping variables to index of order
+    schema = compiled schema of REDCap project
+    indexes = variables given a secondary index, those not in the table are left out
     """
 
+    key = schema.key
+    types = table_column_types(schema, variables)
+
     # Begin query
     table = "CREATE TABLE `" + tbl_name + "` ("
 
     # Go through REDCap variables and translate them to mysql
     for curr_var in variables:
-        var_type = meta[meta_index[str(curr_var)]]['field_type']
-        field_type = ""
-
         # Add to query appropriate details based on variable and type
         if str(curr_var) == key:  # If primary key
             field_type = " int(10) unsigned NOT NULL AUTO_INCREMENT,"
         else:
-            # Look up MySQL data type in dictionary
-            if mysql_field_type.get(var_type) == 'varchar':
-                field_type = " varchar(255) DEFAULT NULL,"
-            elif mysql_field_type.get(var_type) == 'int':
-                field_type = " int(3) DEFAULT NULL,"
+            field_type = " " + types[str(curr_var)] + " DEFAULT NULL,"
 
         # Add to query
         table += "`" + str(curr_var) + "`" + field_type
 
+    # Secondary indexes
+    for index in index_clauses(schema, variables, indexes):
+        table += index + ","
+
     # Finish query
-    table += "PRIMARY KEY (`" + key + "`)) ENGINE=InnoDB DEFAULT CHARSET=latin1;"
+    table += "PRIMARY KEY (`" + key + "`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;"
     curs.execute(table)
 
 
+# Secondary indexes of a table, TEXT columns are indexed on a prefix
+def index_clauses(schema, variables, indexes):
+    types = table_column_types(schema, variables)
+    return ["KEY `" + var + "` (`" + var + "`" + ("(191)" if types[var] == 'text' else "") + ")"
+            for var in indexes if var in variables and var != schema.key]
+
+
+# Add secondary indexes to a table once its rows are loaded, building each index once instead of row by row
+def add_indexes(curs, tbl_name, variables, schema, indexes):
+    clauses = index_clauses(schema, variables, indexes)
+    if len(clauses) > 0:
+        curs.execute("ALTER TABLE `" + tbl_name + "` " + ", ".join("ADD " + clause for clause in clauses))
+
+
+# Put a shadow table in place of a form's table with one atomic RENAME, readers never see a missing or partial table
+def swap_table(curs, form, shadow, exists=True):
+    """
+    curs = cursor for database
+    form = name of the table being replaced
+    shadow = name of the complete table replacing it
+    exists = whether the table being replaced exists, it is kept as form + OLD_SUFFIX until the next swap
+    """
+
+    old = form + OLD_SUFFIX
+    curs.execute("DROP TABLE IF EXISTS `" + old + "`")
+    if exists:
+        curs.execute("RENAME TABLE `" + form + "` TO `" + old + "`, `" + shadow + "` TO `" + form + "`")
+    else:
+        curs.execute("RENAME TABLE `" + shadow + "` TO `" + form + "`")
+
+
+# Form whose rows a table holds, a shadow table holds the rows of the form it replaces
+def table_form(table):
+    return table[:-len(SHADOW_SUFFIX)] if table.endswith(SHADOW_SUFFIX) else table
+
+
 # MARK: API Functions
 
 # From REDCap
 
-# Get variables of REDCap project current form in order
-def get_variable_order(meta, form):
-    var_order = []
-
-    # Go through each variable and add to list
-    for detail in meta:
-        if detail['form_name'] == form:
-            # If checkbox, only one field but multiple variables
-            if detail['field_type'] == "checkbox":
-                for i in range(len(detail['select_choices_or_calculations'].split("|"))):
-                    new_var = detail['field_name'] + "___" + str(i + 1)
-                    var_order.append(new_var)
-            else:
-                var_order.append(detail['field_name'])
+# Get the ID of every record in REDCap project, in the project's order
+def export_record_ids(project, key, date_begin=None):
+    # Only the primary key is exported, longitudinal projects list a record once per event
+    record_ids = dict()
+    for record in project.export_records(fields=[key], date_begin=date_begin):
+        record_ids[record[key]] = None
+    return list(record_ids)
 
-    # Make sure list of variables for each form would have the primary id first
-    if var_order[0] == 'study_id':
-        return var_order
-    else:
-        var_order.insert(0, 'study_id')
-        return var_order
 
+# Export every record of REDCap project, or read them from the export cache if no record changed since it was cached
+def cached_records(project, schema, metrics=None):
+    """
+    :param project: REDCap project being exported
+    :param schema: ProjectSchema of the project, a cache made with other metadata is not used
+    :param metrics: optional TransferMetrics the cache hits are counted in
+    :return: DataFrame of records as strings
+    """
 
-# Get variables from all forms in REDCap project
-def get_all_variables(meta):
-    # Get forms in order
-    forms = list()
-    for field in meta:
-        if field['form_name'] not in forms:
-            forms.append(field['form_name'])
+    key = schema.key
+    with export_cache.project_lock(project):
+        cached = export_cache.read_export(project, schema)
+        if cached is not None:
+            records, exported = cached
+            # Records created or deleted since the export leave the cache stale, and so do records changed since. The
+            # export time is taken from this host's clock, so records changed within the same margin as the watermarks
+            # are exported again and compared with the cached rows
+            if (export_record_ids(project, key) == list(dict.fromkeys(records[key])) and
+                    same_records(project, records, key, exported - timedelta(seconds=WATERMARK_MARGIN))):
+                print("Using the export of '" + str(project.name) + "' cached at " + str(exported))
+                if metrics is not None:
+                    metrics.add('export_cache_hits', 1)
+                return records
+
+        exported = datetime.now().replace(microsecond=0)
+        records = project.export_records(format='df', df_kwargs=frame_read_args)
+        export_cache.write_export(project, schema, records, exported)
+        return records
+
+
+# Whether the records changed in REDCap since a time are the same as their rows in a cached export
+def same_records(project, records, key, since):
+    changed = export_record_ids(project, key, since)
+    if len(changed) == 0:
+        return True
+    current = project.export_records(records=changed, format='df', df_kwargs=frame_read_args)
+    if list(current.columns) != list(records.columns):
+        return False
+    cached = records[records[key].isin(changed)]
+    return cached.astype(object).values.tolist() == current.astype(object).values.tolist()
+
+
+# Export records of REDCap project a chunk of record IDs at a time
+def export_record_chunks(project, key, chunk_size, date_begin=None, metrics=None, record_ids=None, start=0,
+                         concurrency=1, **export_args):
+    """
+    :param project: REDCap project being exported
+    :param key: primary key of REDCap project
+    :param chunk_size: number of records in each chunk
+    :param date_begin: if given, only records created or changed since this datetime are exported
+    :param metrics: optional TransferMetrics the time spent exporting is added to
+    :param record_ids: IDs of the records to export, from export_record_ids, exported here if None
+    :param start: position in record_ids of the first record exported, records before it are already written
+    :param concurrency: number of chunks exported at once, ahead of the chunk being written
+    :param export_args: passed on to export_records, such as the format of the records
+    :return: generator of (records exported so far, total records, records in chunk), CSV is read into a RecordBatch
+    """
 
-    # Go through each form, add its variables to temporary list
-    temp = list()
-    for form in forms:
-        temp.append(get_variable_order(meta, form))
-
-    # Temporary list will be a list of lists, so go through each and all to new list
-    all_variables = list()
-    for form_list in temp:
-        for var in form_list:
-            if var not in all_variables:
-                all_variables.append(var)
-
-    return all_variables
-
-
-# Get dictionary of variables to their index
-def get_metadata_index_dict(meta, var_order):
-    meta_index_dict = {}
-
-    # Because of checkboxes, variables and metadata variables may not be the same, keep track of both
-    var_index = 0
-    metadata_index = 0
-    while var_index < len(var_order):
-        field = var_order[var_index]
-
-        # If field is checkbox, special case: go through all choices before increasing metadata index, increase variable
-        #   index by the number of choices. Otherwise just assign index
-        if meta[metadata_index]['field_type'] == "checkbox":
-            choices = len(meta[metadata_index]['select_choices_or_calculations'].split("|"))
-            for c in range(choices):
-                field = var_order[var_index + c]
-                meta_index_dict[field] = metadata_index
-            var_index += choices
-        else:
-            meta_index_dict[field] = metadata_index
-            var_index += 1
-        metadata_index += 1
+    if metrics is None:
+        metrics = TransferMetrics()
 
-    return meta_index_dict
+    if record_ids is None:
+        with metrics.timer('export'):
+            record_ids = export_record_ids(project, key, date_begin)
+    chunks = [record_ids[position:position + chunk_size] for position in range(start, len(record_ids), chunk_size)]
+    if concurrency > 1:
+        exported = async_redcap.export_chunks(project, chunks, concurrency, **export_args)
+    else:
+        exported = (project.export_records(records=chunk, **export_args) for chunk in chunks)
+
+    # Time spent exporting is the time spent waiting for each chunk
+    done = start
+    try:
+        for chunk in chunks:
+            with metrics.timer('export'):
+                records = next(exported)
+            records = read_records(records)
+            metrics.add('records_exported', len(records))
+            done += len(chunk)
+            yield done, len(record_ids), records
+    finally:
+        exported.close()
 
 
 # MARK: Actions
@@ -309,77 +769,292 @@ def determine_forms_and_overwrite(forms, tables):
     return overwrite, existing
 
 
-def transfer(mysql_database_name, redcap_project_name):
+def transfer(mysql_database_name, redcap_project_name, batch_size=INSERT_BATCH_SIZE, chunk_size=None,
+             incremental=False, workers=1, connect=None, load_strategy='insert', forms=None, overwrite_policy=None,
+             metrics=None, transform='rows', indexes=(), resume=False, concurrency=1, cache=False, files=False):
     """
     :param mysql_database_name: name of mysql database being transferred to
     :param redcap_project_name: name of redcap project being transferred
-    :return:
+    :param batch_size: number of rows sent to mysql and committed together
+    :param chunk_size: if given, records are exported and written this many at a time instead of all at once
+    :param incremental: if True, existing tables are kept and only records changed since the last sync are upserted
+    :param workers: number of tables written at once
+    :param connect: function opening a new connection to the mysql database, needed when workers > 1
+    :param load_strategy: 'insert' for batched INSERT statements, 'infile' for LOAD DATA LOCAL INFILE
+    :param forms: forms to write, all forms of the project if None
+    :param overwrite_policy: 'overwrite' or 'skip' for tables that already exist, None asks
+    :param metrics: optional TransferMetrics the time and throughput of each stage and table are recorded in
+    :param transform: 'rows' to decode records cell by cell, 'dataframe' to export a DataFrame and decode by column
+    :param indexes: variables given a secondary index in the tables created
+    :param resume: if True, tables left unfinished by an earlier transfer are kept and written from their checkpoint
+    :param concurrency: number of chunks exported from REDCap at once when chunk_size is given, above 1 needs aiohttp
+    :param cache: if True, the whole export is kept in a local Parquet file other transfers of the project load from
+    :param files: if True, files uploaded to the file fields of the forms written are copied to the file table
+    :return: dictionary mapping each form written to the number of rows written
     """
 
-    # Load database cursor, project metadata, project primary key, project records, project forms
-    curs = mysql_database_name.cursor()
-    meta = redcap_project_name.metadata
-    key = redcap_project_name.def_field
-    records = redcap_project_name.export_records()
-    forms = list()
-    for field in meta:
-        form = field['form_name']
-        if form not in forms:
-            forms.append(form)
+    if workers > 1 and connect is None:
+        raise ValueError("A connect function is needed to write tables on several workers")
+    if transform not in TRANSFORMS:
+        raise ValueError("Unknown transform '" + str(transform) + "'")
+    if transform == 'dataframe' and pandas is None:
+        raise ValueError("pandas is needed for the 'dataframe' transform")
+    if concurrency > 1 and async_redcap.aiohttp is None:
+        raise ValueError("aiohttp is needed to export chunks concurrently")
+    if cache and (pandas is None or export_cache.pyarrow is None):
+        raise ValueError("pandas and pyarrow are needed for the export cache")
+    if cache and (chunk_size is not None or incremental):
+        raise ValueError("The export cache holds whole exports, it cannot be used with chunk_size or incremental")
+    if metrics is None:
+        metrics = TransferMetrics(redcap_project_name.name or '')
+    metrics.activate()
+
+    # Load database cursor, project schema, project primary key, project forms. Results are buffered so the prepared
+    # statements can run on the connection while a result is still being read
+    curs = mysql_database_name.cursor(buffered=True)
+    with metrics.timer('metadata'):
+        schema = load_schema(redcap_project_name)
+    key = schema.key
+    if forms is not None:
+        for form in forms:
+            if form not in schema.forms:
+                raise ValueError("Did not find form '" + str(form) + "'")
+    forms = [form for form in schema.forms if forms is None or form in forms]
 
     curs.execute("SHOW TABLES")
     tables = list()
     [tables.append(name) for (name,) in curs]
 
-    overwrite, existing = determine_forms_and_overwrite(forms, tables)
-
-    # If only one REDCap form, only look to transfer that
-    if len(redcap_project_name.forms) == 1:
-        mysql_table_name = str(forms[0])
-        form_variables = get_variable_order(meta, mysql_table_name)
-        meta_index = get_metadata_index_dict(meta, form_variables)
-
-        # If MySQL has table with name already, ask to overwrite
-        if mysql_table_name in overwrite:
-            curs.execute('drop table ' + mysql_table_name)
-            # Create the table
-            create_table(curs, mysql_table_name, form_variables, key, meta, meta_index)
-            print("Updating table '" + mysql_table_name + "' ...")
-            # Add all indices to new table
-            add_all_indices(mysql_database_name, curs, mysql_table_name, meta, records,
-                            form_variables, key, meta_index)
-            print(" Done\n")
-
-        # If no table exists with the name, create table and add all indices
-        else:
-            create_table(curs, mysql_table_name, form_variables, key, meta, meta_index)
-            print("Writing table '" + mysql_table_name + "' ...")
-            add_all_indices(mysql_database_name, curs, mysql_table_name, meta, records, form_variables, key, meta_index)
-            print(" Done\n")
-
-    # If multiple REDCap forms, determine which to transfer
+    # LOAD DATA LOCAL INFILE falls back to INSERT when the server has it turned off
+    if load_strategy not in LOAD_STRATEGIES:
+        raise ValueError("Unknown load strategy '" + str(load_strategy) + "'")
+    if load_strategy == 'infile':
+        curs.execute("SHOW VARIABLES LIKE 'local_infile'")
+        setting = curs.fetchone()
+        if setting is None or str(setting[1]).upper() != 'ON':
+            print("Server does not allow LOAD DATA LOCAL INFILE, using INSERT instead")
+            load_strategy = 'insert'
+
+    # Tables an earlier transfer left unfinished are resumed, incremental syncs resume from their watermarks instead
+    project_id = redcap_project_name.name or redcap_project_name.url
+    checkpoints = get_checkpoints(curs, project_id)
+    # Table each form is written to, new and overwritten tables are built as shadow tables and swapped in when done
+    table_of = dict((form, form) for form in forms)
+    resuming = list()
+    if resume and not incremental:
+        for form in forms:
+            if form + SHADOW_SUFFIX in tables and form + SHADOW_SUFFIX in checkpoints:
+                table_of[form] = form + SHADOW_SUFFIX
+            if table_of[form] in tables and table_of[form] in checkpoints:
+                resuming.append(form)
+    deciding = [form for form in forms if form not in resuming]
+
+    # Incremental syncs update existing tables in place, otherwise follow the policy or ask which to overwrite
+    if incremental:
+        watermarks = get_watermarks(curs, project_id)
+        overwrite = list()
+        existing = [form for form in forms if form in tables]
+    elif overwrite_policy is not None:
+        if overwrite_policy not in ['overwrite', 'skip']:
+            raise ValueError("Unknown overwrite policy '" + str(overwrite_policy) + "'")
+        existing = [form for form in deciding if form in tables]
+        overwrite = list(existing) if overwrite_policy == 'overwrite' else list()
+    elif len(deciding) > 0:
+        overwrite, existing = determine_forms_and_overwrite(deciding, tables)
     else:
-        all_variables = get_all_variables(meta)
-        meta_index = get_metadata_index_dict(meta, list(all_variables))
+        overwrite, existing = list(), list()
 
-        for form in forms:
-            form_variables = get_variable_order(meta, form)
-
-            # For each form, see if a MySQL table already exists, if so, ask to overwrite
-            if form in existing:
-                if form in overwrite:
-                    curs.execute("drop table " + str(form))
-                    create_table(curs, form, form_variables, key, meta, meta_index)
-                    print("Updating table '" + form + "' ...")
-                    add_all_indices(mysql_database_name, curs, form, meta, records, form_variables, key, meta_index)
-                    print(" Done\n")
-
-            # No existing table, create table and add all indices
+    # Create a shadow table for each form being written, the form's table is left as it is until the shadow is done
+    writing = list()
+    for form in forms:
+        form_variables = schema.form_variables[form]
+        if form in resuming:
+            print("Resuming table '" + str(table_of[form]) + "'" + (" after record '" + checkpoints[table_of[form]] +
+                                                                    "'" if checkpoints[table_of[form]] != '' else ""))
+        elif form in existing and form not in overwrite:
+            if not incremental:
+                continue
+        else:
+            table_of[form] = form + SHADOW_SUFFIX
+            curs.execute("DROP TABLE IF EXISTS `" + table_of[form] + "`")
+            create_table(curs, table_of[form], form_variables, schema)
+            # A new table is checkpointed before any record is written, so an interrupted transfer can resume it
+            set_checkpoint(mysql_database_name, project_id, table_of[form], '')
+            mysql_database_name.commit()
+        writing.append((form, form_variables, compile_decoder(schema, form_variables)))
+
+    if len(writing) == 0:
+        print("No tables to write")
+        curs.close()
+        return dict()
+
+    # Only export records changed since the oldest sync, unless a table has never been synced
+    date_begin = None
+    if incremental and writing and all(form in existing and form in watermarks for form, _, _ in writing):
+        date_begin = min(watermarks[form] for form, _, _ in writing)
+        print("Syncing records changed since " + str(date_begin))
+    sync_started = datetime.now().replace(microsecond=0) - timedelta(seconds=WATERMARK_MARGIN)
+
+    # Resumed tables take rows again from the start of the batch they stopped in, so they are upserted
+    upserts = set(resuming + ([form for form, _, _ in writing] if incremental else []))
+
+    # Position of the first record each resumed table still needs, in the order REDCap exports records
+    positions = dict()
+
+    def find_positions(record_ids):
+        for form in resuming:
+            if checkpoints[table_of[form]] in record_ids:
+                positions[form] = record_ids.index(checkpoints[table_of[form]]) + 1
+
+    # Records come as CSV read into a RecordBatch for the rows transform, or as a DataFrame of strings
+    export_args = {'format': 'csv'}
+    if transform == 'dataframe':
+        export_args = {'format': 'df', 'df_kwargs': frame_read_args}
+
+    # Only the forms being written are exported, with the primary key, the export cache keeps every form
+    if not cache and len(writing) < len(schema.forms):
+        export_args['forms'] = [form for form, _, _ in writing]
+        export_args['fields'] = [key]
+
+    # Tables are written on a pool of workers, each with its own mysql connection
+    pool = None
+    worker = threading.local()
+    connections = list()
+    if workers > 1:
+        pool = ThreadPoolExecutor(max_workers=workers)
+
+    def write_table(form, form_variables, decoder, records, skip):
+        if not hasattr(worker, 'data'):
+            worker.data = connect()
+            worker.curs = worker.data.cursor(buffered=True)
+            connections.append(worker.data)
+        return add_all_indices(worker.data, worker.curs, table_of[form], records, form_variables, key, decoder,
+                               batch_size, show_progress=False, upsert=form in upserts, load_strategy=load_strategy,
+                               metrics=metrics, skip=skip, project_id=project_id)
+
+    # Forms whose table failed on a worker, these are not written any further
+    errors = dict()
+    # Number of rows written to each table
+    rows_written = dict((form, 0) for form, _, _ in writing)
+
+    # Add records to every table, one after the other or all at once on the pool of workers
+    def write_tables(records, show_progress, offset=0):
+        """
+        :param records: records exported from REDCap project
+        :param show_progress: whether to display each table as it is written
+        :param offset: position of the first of records among all records exported
+        """
+
+        remaining = [(form, form_variables, decoder) for form, form_variables, decoder in writing
+                     if form not in errors]
+
+        if pool is None:
+            for form, form_variables, decoder in remaining:
+                if show_progress:
+                    if form in resuming:
+                        print("Resuming table '" + str(form) + "' ...")
+                    elif form in overwrite:
+                        print("Updating table '" + str(form) + "' ...")
+                    elif form in existing:
+                        print("Syncing table '" + str(form) + "' ...")
+                    else:
+                        print("Writing table '" + str(form) + "' ...")
+                rows_written[form] += add_all_indices(mysql_database_name, curs, table_of[form], records,
+                                                      form_variables, key, decoder, batch_size,
+                                                      show_progress=show_progress, upsert=form in upserts,
+                                                      load_strategy=load_strategy,
+                                                      metrics=metrics, skip=max(0, positions.get(form, 0) - offset),
+                                                      project_id=project_id)
+                if show_progress:
+                    print("Done\n")
+            return
+
+        futures = dict()
+        for form, form_variables, decoder in remaining:
+            futures[pool.submit(write_table, form, form_variables, decoder, records,
+                                max(0, positions.get(form, 0) - offset))] = form
+        for future in as_completed(futures):
+            form = futures[future]
+            # A table failing on a worker only stops that table, its checkpoint is kept for a resumed transfer
+            try:
+                rows_written[form] += future.result()
+                if show_progress:
+                    print("Wrote table '" + str(form) + "'")
+            except Exception as err:
+                errors[form] = err
+                print("Table '" + str(form) + "' failed: " + repr(err))
+
+    # Export all records at once, then add all indices to each table
+    if chunk_size is None:
+        with metrics.timer('export'):
+            if cache:
+                records = cached_records(redcap_project_name, schema, metrics)
             else:
-                create_table(curs, form, form_variables, key, meta, meta_index)
-                print("Writing table '" + str(form) + "' ...")
-                add_all_indices(mysql_database_name, curs, form, meta, records, form_variables, key, meta_index)
-                print(" Done\n")
-
+                records = read_records(redcap_project_name.export_records(date_begin=date_begin, **export_args))
+        metrics.add('records_exported', len(records))
+        if len(resuming) > 0:
+            find_positions(list(records[key]) if pandas is not None and isinstance(records, pandas.DataFrame) else
+                           records.column(key))
+        if pool is not None:
+            print("Writing tables '" + ", ".join(form for form, _, _ in writing) + "' on " + str(workers) +
+                  " workers ...")
+        write_tables(records, True)
+
+    # Export records a chunk at a time, writing each chunk to every table before the next is exported
+    else:
+        print("Writing tables '" + ", ".join(form for form, _, _ in writing) + "' ...")
+        with metrics.timer('export'):
+            record_ids = export_record_ids(redcap_project_name, key, date_begin)
+        find_positions(record_ids)
+
+        # Chunks every table already has are not exported again
+        offset = min(positions.get(form, 0) for form, _, _ in writing)
+        chunks = export_record_chunks(redcap_project_name, key, chunk_size, date_begin, metrics, record_ids, offset,
+                                      concurrency, **export_args)
+        for done, total, records in chunks:
+            write_tables(records, False, offset)
+            metrics.progress('records', done, total)
+            offset = done
+        print("Done\n")
+
+    if pool is not None:
+        pool.shutdown()
+        for connection in connections:
+            connection.close()
+
+    # Shadow tables written to the end are indexed and swapped in, a failed one leaves the form's table as it was
+    for form in [form for form, _, _ in writing if form not in errors]:
+        if table_of[form] != form:
+            with metrics.timer('swap', form):
+                add_indexes(curs, table_of[form], schema.form_variables[form], schema, indexes)
+                swap_table(curs, form, table_of[form], form in tables)
+            if form in tables:
+                print("Swapped in table '" + str(form) + "', the rows it replaced are kept in '" +
+                      str(form) + OLD_SUFFIX + "'")
+
+        # Tables written to the end need no checkpoint
+        clear_checkpoint(mysql_database_name, curs, project_id, table_of[form])
+
+    # Files of file fields are copied once their tables are in place, the tables tell which records have a file
+    if files:
+        for form in [form for form, _, _ in writing if form not in errors]:
+            fields = [var for var in schema.form_variables[form] if schema.field_types.get(var) == 'file']
+            if len(fields) > 0:
+                print("Copying files of '" + str(form) + "' ...")
+                with metrics.timer('files', form):
+                    copied = file_fields.transfer_files(mysql_database_name, curs, redcap_project_name, project_id,
+                                                        form, key, fields, metrics=metrics)
+                print("Copied " + str(copied) + " files")
+
+    # Next sync picks up records changed since this one started, less the margin for the REDCap server's clock
+    if incremental:
+        for form in [form for form, _, _ in writing if form not in errors]:
+            set_watermark(mysql_database_name, project_id, form, sync_started)
+
+    if len(errors) > 0:
+        print("Failed tables: " + ", ".join(errors))
+
+    metrics.finish()
     print("Finished")
     curs.close()
+    return rows_written
@@ -0,0 +1,210 @@
+import asyncio
+import json
+import semantic_version
+import threading
+from collections import deque
+from io import StringIO
+from redcap import RedcapError
+import transfer_metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Number of REDCap API calls in flight at once, each on its own kept-alive connection
+API_CONCURRENCY = 4
+
+# Times a call answered with 429 or 5xx, or that could not reach the server, is tried again before giving up
+API_RETRIES = 5
+
+# Seconds before the first retry, doubled after each one unless the server sends Retry-After
+API_BACKOFF = 1.0
+
+# Seconds one API call may take
+API_TIMEOUT = 600
+
+# Status codes meaning the server is busy or briefly unavailable
+retry_statuses = [429, 500, 502, 503, 504]
+
+
+# REDCap API calls made concurrently on an event loop of their own, for projects on a high-latency server
+class AsyncREDCap:
+    def __init__(self, project, concurrency=API_CONCURRENCY, retries=API_RETRIES, backoff=API_BACKOFF):
+        """
+        :param project: REDCap project, its url, token and primary key are used
+        :param concurrency: number of calls in flight at once
+        :param retries: times a busy or unreachable call is tried again
+        :param backoff: seconds before the first retry
+        """
+
+        if aiohttp is None:
+            raise ValueError("aiohttp is needed to call the REDCap API concurrently")
+
+        self.project = project
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        # Bytes are counted against the transfer that made the client, calls are made on the loop's thread
+        self.metrics = getattr(transfer_metrics.active, 'metrics', None)
+        self.loop = None
+        self.thread = None
+        self.session = None
+        self.semaphore = None
+
+    # Start the event loop on its own thread, with one session pooling the connections to the server
+    def __enter__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.submit(self.open()).result()
+        return self
+
+    def __exit__(self, *args):
+        self.submit(self.session.close()).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         ssl=None if getattr(self.project, 'verify', True) else False)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=API_TIMEOUT))
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+
+    # Run a call on the event loop, returns a concurrent.futures.Future of its result
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def call(self, payload):
+        """
+        :param payload: parameters of the API call
+        :return: text of the response
+        """
+
+        payload = dict((name, str(value)) for name, value in payload.items())
+        for attempt in range(self.retries + 1):
+            async with self.semaphore:
+                try:
+                    async with self.session.post(self.project.url, data=payload) as response:
+                        text = await response.text()
+                        status = response.status
+                        retry_after = response.headers.get('Retry-After')
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    text, status, retry_after = repr(err), None, None
+
+            if self.metrics is not None:
+                self.metrics.add('api_bytes_sent', sum(len(name) + len(value) + 2 for name, value in payload.items()))
+                self.metrics.add('api_bytes_received', len(text))
+
+            if status is not None and status not in retry_statuses:
+                if status >= 400:
+                    raise RedcapError(text)
+                return text
+            if attempt == self.retries:
+                raise RedcapError("REDCap API call failed after " + str(attempt + 1) + " attempts: " + text)
+
+            # Wait as long as the server asks, or back off exponentially
+            delay = self.backoff * 2 ** attempt
+            if retry_after is not None and retry_after.isdigit():
+                delay = int(retry_after)
+            await asyncio.sleep(delay)
+
+    # Export records like Project.export_records, for the formats the transfers use
+    async def export_records(self, records=None, fields=None, forms=None, format='json', df_kwargs=None,
+                             date_begin=None):
+        key = self.project.def_field
+        payload = {'token': self.project.token, 'content': 'record', 'format': 'csv' if format == 'df' else format,
+                   'type': 'flat', 'returnFormat': 'json'}
+
+        # Newer REDCap servers only return the fields asked for, so the primary key is always asked for
+        if forms and not fields:
+            fields = [key]
+        elif fields and key not in fields:
+            fields = list(fields) + [key]
+        for name, values in [('records', records), ('fields', fields), ('forms', forms)]:
+            for index, value in enumerate(values or []):
+                payload[name + "[" + str(index) + "]"] = value
+        if date_begin:
+            payload['dateRangeBegin'] = date_begin.strftime('%Y-%m-%d %H:%M:%S')
+
+        text = await self.call(payload)
+        if format == 'json':
+            return json.loads(text, strict=False)
+        if format == 'df':
+            return self.project.read_csv(StringIO(text), **(df_kwargs or {'index_col': key}))
+        return text
+
+    # Import records like Project.import_records
+    async def import_records(self, records):
+        payload = {'token': self.project.token, 'content': 'record', 'format': 'json', 'type': 'flat',
+                   'data': json.dumps(records), 'overwriteBehavior': 'normal', 'returnFormat': 'json',
+                   'returnContent': 'count', 'dateFormat': 'YMD', 'forceAutoNumber': False}
+        response = json.loads(await self.call(payload), strict=False)
+        if 'error' in response:
+            raise RedcapError(str(response))
+        return response
+
+
+# Export chunks of record IDs several at a time, each chunk's records are given back in the order of chunks
+def export_chunks(project, chunks, concurrency=API_CONCURRENCY, **export_args):
+    """
+    :param project: REDCap project being exported
+    :param chunks: list of lists of record IDs
+    :param concurrency: number of chunks exported at once, and fetched ahead of the one being used
+    :param export_args: passed on to AsyncREDCap.export_records, such as the format of the records
+    :return: generator of the records of each chunk
+    """
+
+    with AsyncREDCap(project, concurrency) as client:
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(client.submit(client.export_records(records=chunk, **export_args)))
+                if len(pending) >= concurrency:
+                    yield pending.popleft().result()
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+# Fill in the attributes of a lazy project like Project.configure, with its metadata, version, events and arms exported
+# at once instead of one after another. Without aiohttp the project configures itself
+def configure_project(project):
+    if aiohttp is None:
+        project.configure()
+        return
+
+    payloads = [{'token': project.token, 'content': content, 'format': 'json', 'returnFormat': 'json'}
+                for content in ['metadata', 'version', 'event', 'arm']]
+    with AsyncREDCap(project) as client:
+        calls = [client.submit(client.call(payload)) for payload in payloads]
+        metadata = json.loads(calls[0].result(), strict=False)
+        version = calls[1].result()
+        # Classic projects answer the event and arm exports with an error
+        longitudinal = []
+        for call in calls[2:]:
+            try:
+                data = json.loads(call.result(), strict=False)
+            except (RedcapError, ValueError):
+                data = None
+            longitudinal.append(data if isinstance(data, list) else [])
+
+    if 'error' in version:
+        version = ''
+    elif semantic_version.validate(version):
+        version = semantic_version.Version(version)
+    events, arms = longitudinal
+
+    project.metadata = metadata
+    project.redcap_version = version
+    project.field_names = [field['field_name'] for field in metadata]
+    project.def_field = project.field_names[0]
+    project.field_labels = [field['field_label'] for field in metadata]
+    project.forms = tuple(set(field['form_name'] for field in metadata))
+    project.events = tuple(events)
+    project.arm_nums = tuple(arm['arm_num'] for arm in arms)
+    project.arm_names = tuple(arm['name'] for arm in arms)
+    project.configured = True
@@ -0,0 +1,127 @@
+"""
+Benchmark both transfers end to end against the local REDCap stand-in and a local MySQL/MariaDB database
+
+python benchmark.py --database (database) --user (user) --password (password) --records 10000 --forms 5
+
+The database should be a scratch database, its tables named after the synthetic forms are overwritten.
+"""
+
+import argparse
+import json
+import multiprocessing
+import resource
+import sys
+import mysql.connector
+import MySQL_to_REDCap_Transfer
+import REDCap_to_MySQL_Transfer
+from project_schema import load_schema
+from redcap import Project
+from redcap_standin import serve_synthetic
+from transfer_metrics import TransferMetrics
+
+
+# Peak resident memory of this process so far, in megabytes
+def peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+# Time REDCap_to_MySQL_Transfer.transfer, overwriting the synthetic forms' tables
+def bench_to_mysql(url, connect, options):
+    metrics = TransferMetrics('to_mysql')
+    project = Project(url=url, token='BENCHMARK', name='benchmark', lazy=True)
+    database = connect()
+    try:
+        REDCap_to_MySQL_Transfer.transfer(database, project, overwrite_policy='overwrite', connect=connect,
+                                          metrics=metrics, **options)
+    finally:
+        database.close()
+    return report(metrics)
+
+
+# Time MySQL_to_REDCap_Transfer.transfer, pushing every table written by bench_to_mysql back to the stand-in
+def bench_to_redcap(url, connect, options):
+    metrics = TransferMetrics('to_redcap')
+    project = Project(url=url, token='BENCHMARK', name='benchmark', lazy=True)
+    schema = load_schema(project)
+    database = connect()
+    try:
+        MySQL_to_REDCap_Transfer.transfer(database, project, transfers=[(form, form) for form in schema.forms],
+                                          rename=False, metrics=metrics, **options)
+    finally:
+        database.close()
+    return report(metrics)
+
+
+# Summary of a run, stage times are added up over every table, so with several workers they exceed the run's time
+def report(metrics):
+    run = metrics.report()
+    stages = dict()
+    rows = 0
+    for target, entry in run['targets'].items():
+        rows += entry['counts'].get('rows', 0)
+        for stage, seconds in entry['seconds'].items():
+            stages[stage] = stages.get(stage, 0) + seconds
+    return {'benchmark': run['name'], 'seconds': run['elapsed_seconds'], 'rows': rows,
+            'rows_per_second': run['targets']['']['rows_per_second'], 'peak_rss_mb': peak_rss(),
+            'stages': dict((stage, round(seconds, 3)) for stage, seconds in stages.items()),
+            'metrics': run}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark transfers against a local REDCap stand-in")
+    parser.add_argument('--database', required=True, help="scratch MySQL database, its tables are overwritten")
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--records', type=int, default=1000)
+    parser.add_argument('--forms', type=int, default=5)
+    parser.add_argument('--fields-per-form', type=int, default=20)
+    parser.add_argument('--checkbox-density', type=float, default=0.2)
+    parser.add_argument('--radio-density', type=float, default=0.3)
+    parser.add_argument('--chunk-size', type=int, default=None, help="stream the REDCap export in chunks")
+    parser.add_argument('--workers', type=int, default=1, help="tables written at once")
+    parser.add_argument('--load-strategy', default='insert', choices=REDCap_to_MySQL_Transfer.LOAD_STRATEGIES)
+    parser.add_argument('--transform', default='rows', choices=REDCap_to_MySQL_Transfer.TRANSFORMS)
+    parser.add_argument('--import-chunk-size', type=int, default=MySQL_to_REDCap_Transfer.IMPORT_CHUNK_SIZE)
+    parser.add_argument('--concurrency', type=int, default=1, help="REDCap API calls at once, needs aiohttp")
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+
+    # The stand-in runs in its own process, so its records do not count towards this process's memory
+    ready = multiprocessing.Queue()
+    standin = multiprocessing.Process(target=serve_synthetic, args=(ready,), daemon=True,
+                                      kwargs={'records': args.records, 'forms': args.forms,
+                                              'fields_per_form': args.fields_per_form,
+                                              'checkbox_density': args.checkbox_density,
+                                              'radio_density': args.radio_density})
+    standin.start()
+    url = ready.get(timeout=60)
+
+    def connect():
+        return mysql.connector.connect(user=args.user, password=args.password, host=args.host,
+                                       database=args.database, allow_local_infile=(args.load_strategy == 'infile'))
+
+    try:
+        results = [bench_to_mysql(url, connect, {'chunk_size': args.chunk_size, 'workers': args.workers,
+                                                 'load_strategy': args.load_strategy, 'transform': args.transform,
+                                                 'concurrency': args.concurrency}),
+                   bench_to_redcap(url, connect, {'chunk_size': args.import_chunk_size,
+                                                  'concurrency': args.concurrency})]
+    finally:
+        standin.terminate()
+
+    print("\n----\n")
+    for result in results:
+        print(result['benchmark'] + ": " + str(result['rows']) + " rows in " + str(result['seconds']) + "s, " +
+              str(result['rows_per_second']) + " rows/s, peak RSS " + str(result['peak_rss_mb']) + " MB")
+        for stage, seconds in result['stages'].items():
+            print("    " + stage + ": " + str(seconds) + "s")
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import json
+import os
+import threading
+from datetime import datetime
+from project_schema import project_digest
+
+try:
+    import pandas
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Directory whole exports of REDCap projects are cached in, a Parquet file of records and a manifest per project
+EXPORT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ycmi', 'export_cache')
+
+# One lock per project, so transfers of the same project to several databases export it only once
+project_locks = dict()
+project_locks_lock = threading.Lock()
+
+
+# Lock held while a project's cached export is checked, and replaced if it is stale
+def project_lock(project):
+    with project_locks_lock:
+        return project_locks.setdefault(project_digest(project), threading.Lock())
+
+
+# Read the cached export of a project, None if there is none for the project's current metadata
+def read_export(project, schema, cache_dir=EXPORT_CACHE_DIR):
+    """
+    :param project: REDCap project
+    :param schema: ProjectSchema of the project, the cache is only used if it was exported with the same metadata
+    :param cache_dir: directory the exports are cached in
+    :return: (DataFrame of records as strings, datetime the export started) or None
+    """
+
+    path = os.path.join(cache_dir, project_digest(project))
+    if not (os.path.exists(path + '.json') and os.path.exists(path + '.parquet')):
+        return None
+    try:
+        with open(path + '.json') as manifest:
+            manifest = json.load(manifest)
+    except ValueError:
+        return None
+    if manifest.get('metadata_digest') != schema.digest:
+        return None
+
+    # Columns are memory-mapped from the file instead of read into a buffer first
+    records = pandas.read_parquet(path + '.parquet', memory_map=True)
+    return records, datetime.fromisoformat(manifest['exported'])
+
+
+# Write the export of a project to the cache, the manifest is written last so a half written export is never used
+def write_export(project, schema, records, exported, cache_dir=EXPORT_CACHE_DIR):
+    """
+    :param project: REDCap project
+    :param schema: ProjectSchema of the project, its compiled metadata is cached under schema.digest
+    :param records: DataFrame of records as strings
+    :param exported: datetime the export started, records changed after it make the cache stale
+    :param cache_dir: directory the exports are cached in
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, project_digest(project))
+    if os.path.exists(path + '.json'):
+        os.remove(path + '.json')
+
+    records.to_parquet(path + '.parquet.tmp', index=False)
+    os.replace(path + '.parquet.tmp', path + '.parquet')
+    with open(path + '.json.tmp', 'w') as manifest:
+        json.dump({'metadata_digest': schema.digest, 'exported': exported.isoformat(), 'records': len(records),
+                   'name': getattr(project, 'name', '')}, manifest)
+    os.replace(path + '.json.tmp', path + '.json')
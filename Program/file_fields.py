@@ -0,0 +1,204 @@
+import hashlib
+import os
+import re
+import requests
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from mysql_pool import execute_prepared
+from redcap import RedcapError
+from requests.adapters import HTTPAdapter
+
+# Table the files uploaded to REDCap file fields are listed in, one row per record and field, and the table their
+# contents are copied to, one row per chunk. A file is read back by concatenating its chunks in the order of `seq`
+FILE_TABLE = 'redcap_file'
+FILE_CHUNK_TABLE = 'redcap_file_chunk'
+
+# Number of files downloaded from REDCap at once
+FILE_WORKERS = 4
+
+# Bytes of a file read from REDCap, and sent to mysql in one statement, at a time
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# Downloads started ahead of the file being written, for each worker
+FILE_AHEAD = 2
+
+# Seconds one file may take to start downloading
+FILE_TIMEOUT = 600
+
+# Skip downloading a file whose name and size are those of the file already copied, False downloads and hashes every
+# file, which also catches a file replaced by another of the same name and size
+FILE_SKIP_SAME_SIZE = True
+
+
+# Get the size and hash of each file already copied for some fields, creating the file table if needed
+def get_stored_files(curs, project_id, fields):
+    """
+    :param curs: cursor for database
+    :param project_id: name identifying the REDCap project
+    :param fields: file fields of REDCap project
+    :return: dictionary mapping (record, field) to (name, size, sha1)
+    """
+
+    curs.execute("CREATE TABLE IF NOT EXISTS `" + FILE_TABLE + "` (`project` varchar(255) NOT NULL, "
+                 "`record` varchar(255) NOT NULL, `field` varchar(100) NOT NULL, `name` varchar(255) DEFAULT NULL, "
+                 "`size` bigint unsigned NOT NULL, `sha1` char(40) NOT NULL, "
+                 "PRIMARY KEY (`project`, `record`, `field`)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4")
+    curs.execute("CREATE TABLE IF NOT EXISTS `" + FILE_CHUNK_TABLE + "` (`project` varchar(255) NOT NULL, "
+                 "`record` varchar(255) NOT NULL, `field` varchar(100) NOT NULL, `seq` int unsigned NOT NULL, "
+                 "`content` mediumblob NOT NULL, PRIMARY KEY (`project`, `record`, `field`, `seq`)) "
+                 "ENGINE=InnoDB DEFAULT CHARSET=utf8mb4")
+    stored = dict()
+    for field in fields:
+        curs.execute("SELECT `record`, `name`, `size`, `sha1` FROM `" + FILE_TABLE + "` WHERE `project` = %s AND "
+                     "`field` = %s", (project_id, field))
+        for record, name, size, digest in curs.fetchall():
+            stored[(str(record), field)] = (name, int(size), digest)
+    return stored
+
+
+# Download a file to a spool file a chunk at a time, None if it is the same as the file already copied
+def download_file(session, project, record, field, stored=None):
+    """
+    :param session: requests session the file is downloaded on
+    :param project: REDCap project
+    :param record: record the file is uploaded to
+    :param field: file field the file is uploaded to
+    :param stored: (name, size, sha1) of the file already copied, if any
+    :return: (name of file, path of spool file, size, sha1), or None if the file is unchanged
+    """
+
+    payload = {'token': project.token, 'content': 'file', 'action': 'export', 'record': record, 'field': field,
+               'returnFormat': 'json'}
+    with session.post(project.url, data=payload, stream=True, timeout=FILE_TIMEOUT,
+                      verify=getattr(project, 'verify', True)) as response:
+        if response.status_code != 200:
+            raise RedcapError(response.text)
+
+        # A file whose name and size have not changed is not downloaded, unless the server does not send its size
+        name = re.search(r'name="([^"]*)"', response.headers.get('Content-Type', ''))
+        name = name.group(1) if name else None
+        size = response.headers.get('Content-Length')
+        if FILE_SKIP_SAME_SIZE and stored is not None and size is not None and \
+                'Content-Encoding' not in response.headers and (name, int(size)) == stored[:2]:
+            return None
+
+        digest = hashlib.sha1()
+        size = 0
+        spool = tempfile.NamedTemporaryFile('wb', suffix='.file', delete=False)
+        with spool:
+            for chunk in response.iter_content(FILE_CHUNK_SIZE):
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+
+    if stored is not None and (name, size, digest.hexdigest()) == stored:
+        os.remove(spool.name)
+        return None
+    return name, spool.name, size, digest.hexdigest()
+
+
+# Copy a spool file to the chunk table a row per chunk, so each chunk is written once, committed once the whole file
+# is there
+def store_file(data, curs, project_id, record, field, name, path, size, digest):
+    curs.execute("INSERT INTO `" + FILE_TABLE + "` (`project`, `record`, `field`, `name`, `size`, `sha1`) "
+                 "VALUES (%s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE `name` = VALUES(`name`), "
+                 "`size` = VALUES(`size`), `sha1` = VALUES(`sha1`)", (project_id, record, field, name, size, digest))
+    curs.execute("DELETE FROM `" + FILE_CHUNK_TABLE + "` WHERE `project` = %s AND `record` = %s AND `field` = %s",
+                 (project_id, record, field))
+    with open(path, 'rb') as spool:
+        for seq, chunk in enumerate(iter(lambda: spool.read(FILE_CHUNK_SIZE), b'')):
+            execute_prepared(data, "INSERT INTO `" + FILE_CHUNK_TABLE + "` (`project`, `record`, `field`, `seq`, "
+                             "`content`) VALUES (%s, %s, %s, %s, %s)", (project_id, record, field, seq, chunk))
+    data.commit()
+
+
+# Copy the files uploaded to the file fields of a table's records, downloading several at once
+def transfer_files(data, curs, project, project_id, table, key, fields, workers=FILE_WORKERS, metrics=None):
+    """
+    :param data: database being used
+    :param curs: cursor for database
+    :param project: REDCap project the files are downloaded from
+    :param project_id: name identifying the REDCap project
+    :param table: mysql table of the form the fields are in, its rows tell which records have a file
+    :param key: primary key of REDCap project
+    :param fields: file fields of the form
+    :param workers: number of files downloaded at once
+    :param metrics: optional TransferMetrics the files copied and skipped are counted in
+    :return: number of files copied
+    """
+
+    if len(fields) == 0:
+        return 0
+
+    stored = get_stored_files(curs, project_id, fields)
+    uploaded = list()
+    for field in fields:
+        curs.execute("SELECT `" + key + "` FROM `" + table + "` WHERE `" + field + "` <> ''")
+        uploaded += [(str(record), field) for (record,) in curs.fetchall()]
+
+    # Files deleted from REDCap are deleted from the file table too
+    current = set(uploaded)
+    gone = [(project_id, record, field) for record, field in stored if (record, field) not in current]
+    if len(gone) > 0:
+        for file_table in [FILE_TABLE, FILE_CHUNK_TABLE]:
+            execute_prepared(data, "DELETE FROM `" + file_table + "` WHERE `project` = %s AND `record` = %s "
+                             "AND `field` = %s", gone, many=True)
+        data.commit()
+
+    # Files are downloaded on the workers and written to mysql on this connection as each one arrives. Only a few
+    # downloads are ahead of the file being written, so the spool files on disk are bounded however slow mysql is
+    session = requests.Session()
+    session.mount(project.url, HTTPAdapter(pool_maxsize=workers))
+    copied = 0
+    waiting = iter(uploaded)
+    pending = dict()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+
+        # Start downloads until as many as allowed are ahead
+        def refill():
+            for record, field in waiting:
+                pending[pool.submit(download_file, session, project, record, field, stored.get((record, field)))] = \
+                    (record, field)
+                if len(pending) >= workers * FILE_AHEAD:
+                    break
+
+        try:
+            refill()
+            while len(pending) > 0:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    record, field = pending.pop(future)
+                    # A file that cannot be downloaded is reported and the other files are still copied
+                    try:
+                        downloaded = future.result()
+                    except (RedcapError, requests.RequestException) as err:
+                        print("File of '" + field + "' of record '" + record + "' failed: " + str(err))
+                        if metrics is not None:
+                            metrics.add('files_failed', 1, table)
+                        continue
+                    if downloaded is None:
+                        if metrics is not None:
+                            metrics.add('files_unchanged', 1, table)
+                        continue
+
+                    name, path, size, digest = downloaded
+                    try:
+                        store_file(data, curs, project_id, record, field, name, path, size, digest)
+                    finally:
+                        os.remove(path)
+                    copied += 1
+                    if metrics is not None:
+                        metrics.add('files_copied', 1, table)
+                        metrics.add('file_bytes', size, table)
+                refill()
+        finally:
+            # Downloads not started are dropped, those that finished without being written leave no spool file
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for future in pending:
+                if not future.cancelled() and future.exception() is None and future.result() is not None:
+                    os.remove(future.result()[1])
+    session.close()
+
+    return copied
@@ -0,0 +1,82 @@
+import threading
+import time
+from mysql.connector import pooling
+from passwords import Mysql_Tables
+
+# Connections kept open to each database, shared by every transfer and job of the process, at most 32
+POOL_SIZE = 8
+
+# Seconds to wait for a connection when every connection of a pool is in use
+POOL_TIMEOUT = 300
+
+# Pools of open connections, keyed by database and connection options
+pools = dict()
+pools_lock = threading.Lock()
+
+
+# Pool of connections to a mysql database from passwords.py, made the first time it is asked for. Connections are not
+# buffered, which prepared cursors and streamed rows need, cursors that should be buffered ask for it
+def get_pool(database, **kwargs):
+    """
+    :param database: name of the database in passwords.Mysql_Tables
+    :param kwargs: more connection options, such as allow_local_infile
+    :return: MySQLConnectionPool
+    """
+
+    pool_key = (database, tuple(sorted(kwargs.items())))
+    with pools_lock:
+        if pool_key not in pools:
+            user, password, host = Mysql_Tables[database]
+            pools[pool_key] = pooling.MySQLConnectionPool(
+                pool_name="ycmi_" + str(len(pools)),
+                pool_size=POOL_SIZE,
+                user=user,
+                password=password,
+                host=host,
+                database=database,
+                **kwargs
+            )
+        return pools[pool_key]
+
+
+# Function borrowing a connection to a mysql database from its pool, closing the connection gives it back
+def connector(database, **kwargs):
+    pool = get_pool(database, **kwargs)
+
+    def connect():
+        waited = 0
+        while True:
+            try:
+                return pool.get_connection()
+            except pooling.PoolError:
+                if waited >= POOL_TIMEOUT:
+                    raise
+                time.sleep(0.1)
+                waited += 0.1
+    return connect
+
+
+# Execute a statement as a server-side prepared statement, prepared once per connection and reused after that
+def execute_prepared(data, statement, params, many=False):
+    """
+    :param data: database being used
+    :param statement: statement with %s placeholders
+    :param params: values of the placeholders, or a list of them if many
+    :param many: whether the statement is executed once for each entry of params
+    :return: cursor the statement was executed on
+    """
+
+    # The connector only reuses a preparation when given the very same string, so the first one is kept
+    cursors = getattr(data, 'prepared_cursors', None)
+    if cursors is None:
+        cursors = dict()
+        data.prepared_cursors = cursors
+    if statement not in cursors:
+        cursors[statement] = (data.cursor(prepared=True), statement)
+    curs, statement = cursors[statement]
+
+    if many:
+        curs.executemany(statement, params)
+    else:
+        curs.execute(statement, params)
+    return curs
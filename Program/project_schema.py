@@ -0,0 +1,183 @@
+import async_redcap
+import hashlib
+import json
+import os
+import semantic_version
+import tempfile
+import time
+
+# Directory compiled project schemas are cached in
+SCHEMA_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.ycmi', 'schema_cache')
+
+# Seconds a cached schema is trusted without downloading the project's metadata again, 0 always downloads it
+SCHEMA_MAX_AGE = 0
+
+# Version of the compiled schema, cached schemas of another version are compiled again
+SCHEMA_FORMAT = 2
+
+# Project attributes filled in by Project.configure that are kept with the schema
+project_attributes = ['metadata', 'redcap_version', 'field_names', 'def_field', 'field_labels', 'forms', 'events',
+                      'arm_nums', 'arm_names']
+
+
+# Variable names REDCap exports for each choice of a checkbox field
+def checkbox_variables(field):
+    variables = []
+    for option in str(field['select_choices_or_calculations']).split("|"):
+        code = option.split(",")[0].strip().lower().replace("-", "_")
+        variables.append(field['field_name'] + "___" + code)
+    return variables
+
+
+# Everything the transfers need to know about the fields of a REDCap project, compiled in one pass over the metadata
+class ProjectSchema:
+    def __init__(self, metadata, digest, project_info=None):
+        """
+        :param metadata: metadata from REDCap project
+        :param digest: hash of the metadata
+        :param project_info: project attributes kept with the schema, see project_attributes
+        """
+
+        self.metadata = metadata
+        self.digest = digest
+        self.project_info = project_info or dict()
+
+        # Primary key of the project is its first field
+        self.key = metadata[0]['field_name'] if len(metadata) > 0 else None
+
+        # Forms in order, variables of each form in order with the primary key first
+        self.forms = list()
+        self.form_variables = dict()
+        # Variables REDCap exports for each checkbox field
+        self.checkbox = dict()
+        # Index in metadata and field type of every variable
+        self.meta_index = dict()
+        self.field_types = dict()
+
+        for index, field in enumerate(metadata):
+            # Descriptive fields only show text on the form, REDCap does not export them
+            if field['field_type'] == "descriptive":
+                continue
+            form = field['form_name']
+            if form not in self.form_variables:
+                self.forms.append(form)
+                self.form_variables[form] = [] if field['field_name'] == self.key else [self.key]
+
+            if field['field_type'] == "checkbox":
+                variables = checkbox_variables(field)
+                self.checkbox[field['field_name']] = variables
+            else:
+                variables = [field['field_name']]
+
+            for var in variables:
+                self.form_variables[form].append(var)
+                self.meta_index[var] = index
+                self.field_types[var] = field['field_type']
+
+    # Metadata of the field a variable belongs to
+    def field(self, var):
+        return self.metadata[self.meta_index[var]]
+
+    def to_json(self):
+        return {'format': SCHEMA_FORMAT, 'metadata': self.metadata, 'digest': self.digest,
+                'project_info': self.project_info, 'key': self.key, 'forms': self.forms,
+                'form_variables': self.form_variables, 'checkbox': self.checkbox, 'meta_index': self.meta_index,
+                'field_types': self.field_types}
+
+    @classmethod
+    def from_json(cls, cached):
+        # The compiled parts are read back as they are instead of being recompiled
+        schema = cls.__new__(cls)
+        for name, value in cached.items():
+            setattr(schema, name, value)
+        return schema
+
+    # Fill in the attributes of a lazy project, so it is not configured again
+    def apply(self, project):
+        for name, value in self.project_info.items():
+            setattr(project, name, value)
+        if project.redcap_version:
+            project.redcap_version = semantic_version.Version(project.redcap_version)
+        project.forms = tuple(project.forms)
+        project.metadata = self.metadata
+        project.configured = True
+
+
+# Hash of REDCap project metadata, used as the key of its cached schema
+def metadata_digest(metadata):
+    return hashlib.sha256(json.dumps(metadata, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Hash of a REDCap project's url and token, the latest schema and export of a project are found by it so neither
+# the url nor the token is stored
+def project_digest(project):
+    return hashlib.sha256((str(project.url) + "|" + str(project.token)).encode('utf-8')).hexdigest()
+
+
+# Load the compiled schema of a REDCap project, from the cache when its metadata has not changed
+def load_schema(project, cache_dir=SCHEMA_CACHE_DIR, max_age=SCHEMA_MAX_AGE):
+    """
+    :param project: REDCap project, may be created with lazy=True so its metadata is only downloaded when needed
+    :param cache_dir: directory the compiled schemas are cached in
+    :param max_age: seconds a cached schema of a lazy project is used without downloading the metadata again
+    :return: ProjectSchema of the project
+    """
+
+    latest_path = os.path.join(cache_dir, project_digest(project) + '.json')
+
+    if not getattr(project, 'configured', True):
+        if max_age > 0 and os.path.exists(latest_path) and time.time() - os.path.getmtime(latest_path) < max_age:
+            with open(latest_path) as latest:
+                schema = read_schema(cache_dir, json.load(latest)['digest'])
+            if schema is not None:
+                schema.apply(project)
+                return schema
+        async_redcap.configure_project(project)
+
+    digest = metadata_digest(project.metadata)
+    schema = read_schema(cache_dir, digest)
+    if schema is None:
+        project_info = dict((name, getattr(project, name, None)) for name in project_attributes if name != 'metadata')
+        if project_info['redcap_version'] is not None:
+            project_info['redcap_version'] = str(project_info['redcap_version'])
+        schema = ProjectSchema(project.metadata, digest, project_info)
+        write_schema(cache_dir, schema)
+
+    write_json(cache_dir, latest_path, {'digest': digest})
+
+    return schema
+
+
+# Read a cached schema, None if there is none for the metadata hash
+def read_schema(cache_dir, digest):
+    path = os.path.join(cache_dir, digest + '.json')
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as cached:
+            cached = json.load(cached)
+    except ValueError:
+        return None
+    if cached.get('format') != SCHEMA_FORMAT:
+        return None
+    return ProjectSchema.from_json(cached)
+
+
+# Write a schema to the cache
+def write_schema(cache_dir, schema):
+    write_json(cache_dir, os.path.join(cache_dir, schema.digest + '.json'), schema.to_json())
+
+
+# Write a file of the cache through a temporary file of its own, so a half written file is never left under the
+# final name, and jobs writing the same file at once do not replace each other's temporary file
+def write_json(cache_dir, path, value):
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    try:
+        with os.fdopen(handle, 'w') as temp:
+            json.dump(value, temp)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
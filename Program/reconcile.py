@@ -0,0 +1,265 @@
+"""
+Check that MySQL tables hold the same records as the REDCap forms they were transferred from, without comparing every
+row: both sides are hashed a key range at a time and only ranges that differ are narrowed down to their records
+
+python reconcile.py (project) (database) [form ...] [--codes]
+
+Projects and databases are looked up in passwords.py. Each form is checked against the table of the same name,
+every form of the project if none is given. Tables written by to_MySQL.py hold labels, use --codes for tables that
+hold REDCap's codes, such as tables imported with to_REDCap.py. Tables whose primary key is not an integer are
+narrowed down by ranges of a hash of the key instead of the key itself.
+"""
+
+import argparse
+import hashlib
+import re
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from REDCap_to_MySQL_Transfer import compile_decoder, export_record_chunks
+from project_schema import load_schema
+
+# Number of parts a key range that differs is split into, each part is hashed by one GROUP BY query
+RANGE_PARTS = 16
+
+# Rows of a range compared record by record instead of split again
+LEAF_ROWS = 64
+
+# Number of records exported from REDCap at a time while hashing them
+VERIFY_CHUNK_SIZE = 1000
+
+# Places of DOUBLE and FLOAT values compared, floating point values are rounded to them on both sides
+FLOAT_PLACES = 6
+
+
+# SQL and Python conversion of a column to the text that is hashed, the same on both sides for the same value
+def column_text(name, column_type):
+    """
+    :param name: name of the column
+    :param column_type: type of the column, as SHOW COLUMNS gives it
+    :return: (SQL expression of the column's text, function giving the same text for a REDCap value)
+    """
+
+    column = "`" + name + "`"
+    column_type = column_type.lower()
+    scale = re.match(r'decimal\(\d+,(\d+)\)', column_type)
+    if scale or column_type.startswith(('double', 'float')):
+        places = int(scale.group(1)) if scale else FLOAT_PLACES
+        sql = "CAST(" + column + " AS DECIMAL(65," + str(places) + "))" if not scale else column
+        return sql, lambda value: fixed_point(value, places)
+    if re.match(r'(tiny|small|medium|big)?int\b', column_type):
+        return column, lambda value: str(int(value)) if re.fullmatch(r'[-+]?\d+', value) else value
+    if column_type.startswith(('datetime', 'timestamp')):
+        return column, lambda value: value + ":00" if len(value) == 16 else value
+    return column, lambda value: value
+
+
+# Decimal text of a number with a fixed number of places, as mysql gives a DECIMAL column
+def fixed_point(value, places):
+    try:
+        return str(Decimal(value).quantize(Decimal(1).scaleb(-places)))
+    except InvalidOperation:
+        return value
+
+
+# Hash of a row's texts, the first 64 bits of their MD5
+def row_hash(texts):
+    return int(hashlib.md5("\x1f".join(texts).encode('utf-8')).hexdigest()[:16], 16)
+
+
+# Position of a record ID in the key space narrowed down, the ID itself for an integer key column, otherwise the
+# first 60 bits of the MD5 of the ID, so string IDs are spread over ranges the same way on both sides
+def key_position(record, integer_key):
+    if integer_key:
+        return int(record)
+    return int(hashlib.md5(str(record).encode('utf-8')).hexdigest()[:15], 16)
+
+
+# Hashes of every record of a form in REDCap, exported a chunk at a time
+def redcap_hashes(project, schema, form, converters, decode=True, chunk_size=VERIFY_CHUNK_SIZE):
+    """
+    :param project: REDCap project
+    :param schema: compiled schema of REDCap project
+    :param form: form being checked
+    :param converters: function giving the text of each variable's value, from column_text
+    :param decode: whether values are decoded to labels as to_MySQL.py writes them
+    :param chunk_size: number of records exported at a time
+    :return: dictionary mapping record ID to hash
+    """
+
+    variables = schema.form_variables[form]
+    decoder = compile_decoder(schema, variables) if decode else [(var, None) for var in variables]
+    export_args = {'format': 'csv', 'forms': [form], 'fields': [schema.key]}
+
+    hashes = dict()
+    for _, _, records in export_record_chunks(project, schema.key, chunk_size, **export_args):
+        for values in records.project(variables):
+            texts = []
+            for value, (_, labels), convert in zip(values, decoder, converters):
+                value = value if labels is None else labels[value]
+                texts.append('' if value is None or value == '' else convert(value))
+            hashes[values[0]] = row_hash(texts)
+    return hashes
+
+
+# Compare a mysql table with a REDCap form, returns the records that differ
+def reconcile_table(curs, project, schema, form, table=None, decode=True, chunk_size=VERIFY_CHUNK_SIZE):
+    """
+    :param curs: cursor for database
+    :param project: REDCap project
+    :param schema: compiled schema of REDCap project
+    :param form: form being checked
+    :param table: mysql table holding the form, the form's name if None
+    :param decode: whether the table holds labels, as to_MySQL.py writes them, instead of codes
+    :param chunk_size: number of records exported from REDCap at a time
+    :return: dictionary of the records only in REDCap, only in mysql, and different, and the queries it took
+    """
+
+    table = table or form
+    key = schema.key
+    variables = schema.form_variables[form]
+
+    # Each column is hashed as text, NULL as an empty string, converted the same way on both sides
+    curs.execute("SHOW COLUMNS FROM `" + table + "`")
+    column_types = dict((row[0], row[1].decode() if isinstance(row[1], bytes) else row[1]) for row in curs.fetchall())
+    if key not in column_types:
+        raise ValueError("Did not find the primary key '" + key + "' in table '" + table + "'")
+    texts = [column_text(var, column_types.get(var, 'text')) for var in variables]
+    row_sql = ("CAST(CONV(SUBSTRING(MD5(CONCAT_WS(CHAR(31 USING utf8mb4), " +
+               ", ".join("COALESCE(CAST(" + sql + " AS CHAR), '')" for sql, _ in texts) + ")), 1, 16), 16, 10) "
+               "AS UNSIGNED)")
+
+    # Ranges are of the key itself if it is an integer, otherwise of a hash of the key, see key_position
+    integer_key = re.match(r'(tiny|small|medium|big)?int\b', column_types[key].lower()) is not None
+    if integer_key:
+        position_sql = "`" + key + "`"
+    else:
+        position_sql = "CAST(CONV(SUBSTRING(MD5(`" + key + "`), 1, 15), 16, 10) AS UNSIGNED)"
+    queries = 0
+
+    different = {'only_in_redcap': [], 'only_in_mysql': [], 'different': []}
+    hashes = redcap_hashes(project, schema, form, [convert for _, convert in texts], decode, chunk_size)
+    records = len(hashes)
+    if integer_key:
+        # Records whose ID is not an integer cannot be in the table, the others are keyed the way mysql gives them
+        different['only_in_redcap'] += [record for record in hashes if not re.fullmatch(r'[-+]?\d+', record)]
+        hashes = dict((str(int(record)), value) for record, value in hashes.items()
+                      if re.fullmatch(r'[-+]?\d+', record))
+    entries = sorted((key_position(record, integer_key), record) for record in hashes)
+    positions = [position for position, _ in entries]
+    ordered = [hashes[record] for _, record in entries]
+
+    # Number of records and XOR of their hashes between two positions, in REDCap
+    def redcap_range(low, high):
+        first, last = bisect_left(positions, low), bisect_right(positions, high)
+        total = 0
+        for value in ordered[first:last]:
+            total ^= value
+        return last - first, total
+
+    # Compare the records between two positions one by one
+    def compare_rows(low, high):
+        nonlocal queries
+        curs.execute("SELECT `" + key + "`, " + row_sql + " FROM `" + table + "` WHERE " + position_sql +
+                     " BETWEEN %s AND %s", (low, high))
+        queries += 1
+        rows = dict((str(record), int(value)) for record, value in curs.fetchall())
+        for _, record in entries[bisect_left(positions, low):bisect_right(positions, high)]:
+            if record not in rows:
+                different['only_in_redcap'].append(record)
+            elif rows.pop(record) != hashes[record]:
+                different['different'].append(record)
+        different['only_in_mysql'] += sorted(rows, key=lambda record: key_position(record, integer_key))
+
+    # Split a range that differs into parts, hashed by one query, and narrow down the parts that differ
+    def compare_range(low, high):
+        nonlocal queries
+        width = -(-(high - low + 1) // RANGE_PARTS)
+        curs.execute("SELECT FLOOR((" + position_sql + " - %s) / %s) AS part, COUNT(*), BIT_XOR(" + row_sql +
+                     ") FROM `" + table + "` WHERE " + position_sql + " BETWEEN %s AND %s GROUP BY part",
+                     (low, width, low, high))
+        queries += 1
+        parts = dict((int(part), (int(count), int(total))) for part, count, total in curs.fetchall())
+        for part in range(RANGE_PARTS):
+            start = low + part * width
+            end = min(high, start + width - 1)
+            if start > high:
+                break
+            mysql_part = parts.get(part, (0, 0))
+            redcap_part = redcap_range(start, end)
+            if mysql_part == redcap_part:
+                continue
+            if mysql_part[0] + redcap_part[0] <= LEAF_ROWS or start == end:
+                compare_rows(start, end)
+            else:
+                compare_range(start, end)
+
+    # The whole table is hashed first, most tables that match take this one query
+    curs.execute("SELECT MIN(" + position_sql + "), MAX(" + position_sql + "), COUNT(*), BIT_XOR(" + row_sql +
+                 ") FROM `" + table + "`")
+    queries += 1
+    low, high, count, total = curs.fetchone()
+    if (int(count), int(total or 0)) != (redcap_range(positions[0], positions[-1]) if positions else (0, 0)):
+        bounds = [int(value) for value in [low, high] if value is not None] + positions[:1] + positions[-1:]
+        compare_range(min(bounds), max(bounds))
+
+    different['records'] = records
+    different['queries'] = queries
+    return different
+
+
+# Compare the tables of a database with the forms of a REDCap project, printing what differs
+def reconcile(mysql_database_name, redcap_project_name, forms=None, decode=True):
+    """
+    :param mysql_database_name: database holding the tables
+    :param redcap_project_name: REDCap project
+    :param forms: forms to check, all forms of the project if None
+    :param decode: whether the tables hold labels, as to_MySQL.py writes them, instead of codes
+    :return: dictionary mapping each form to what differs, from reconcile_table
+    """
+
+    curs = mysql_database_name.cursor(buffered=True)
+    schema = load_schema(redcap_project_name)
+    results = dict()
+    for form in forms or schema.forms:
+        start = datetime.now()
+        results[form] = reconcile_table(curs, redcap_project_name, schema, form, decode=decode)
+        result = results[form]
+        seconds = str(round((datetime.now() - start).total_seconds(), 1))
+        if not (result['only_in_redcap'] or result['only_in_mysql'] or result['different']):
+            print("'" + form + "': " + str(result['records']) + " records match (" + str(result['queries']) +
+                  " queries, " + seconds + " seconds)")
+            continue
+        print("'" + form + "' differs (" + str(result['queries']) + " queries, " + seconds + " seconds)")
+        for name, title in [('only_in_redcap', "Only in REDCap"), ('only_in_mysql', "Only in MySQL"),
+                            ('different', "Different")]:
+            if result[name]:
+                print("  " + title + ": " + ", ".join(str(record) for record in result[name]))
+    curs.close()
+    return results
+
+
+if __name__ == '__main__':
+    from mysql_pool import connector
+    from passwords import valid_mysql, valid_redcap, REDCap_Projects
+    from redcap import Project
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument('project')
+    parser.add_argument('database')
+    parser.add_argument('forms', nargs='*')
+    parser.add_argument('--codes', action='store_true', help="tables hold REDCap's codes instead of labels")
+    args = parser.parse_args()
+
+    if not valid_redcap(args.project):
+        print("Do not recognize REDCap project")
+    elif not valid_mysql(args.database):
+        print("Do not recognize MySQL database")
+    else:
+        project = Project(url=REDCap_Projects[args.project][0], token=REDCap_Projects[args.project][1],
+                          name=args.project, verify_ssl=False, lazy=True)
+        database = connector(args.database)()
+        try:
+            reconcile(database, project, args.forms or None, decode=not args.codes)
+        finally:
+            database.close()
@@ -0,0 +1,178 @@
+"""
+Local stand-in for the REDCap API calls PyCap makes, for benchmarks and offline runs
+
+python redcap_standin.py (port) (records) (forms)
+"""
+
+import csv
+import io
+import json
+import random
+import sys
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from synthetic_project import make_metadata, make_records
+
+# Version reported to PyCap
+STANDIN_VERSION = '10.0.0'
+
+# Largest made up file of a file upload field, in bytes
+STANDIN_FILE_SIZE = 256 * 1024
+
+
+# Project held by the stand-in: metadata, and records in the order they were added
+class StandInProject:
+    def __init__(self, metadata, records):
+        self.metadata = metadata
+        self.key = metadata[0]['field_name']
+        self.records = dict()
+        # When each record was last created or changed, for date range exports
+        self.changed = dict()
+        self.import_records(records)
+
+        # Variables of each field and each form, checkboxes expanded, forms with their complete field
+        self.field_variables = dict()
+        self.form_variables = dict()
+        for field in metadata:
+            if field['field_type'] == 'descriptive':
+                continue
+            if field['field_type'] == 'checkbox':
+                variables = [field['field_name'] + "___" + option.split(",")[0].strip().lower()
+                             for option in field['select_choices_or_calculations'].split("|")]
+            else:
+                variables = [field['field_name']]
+            self.field_variables[field['field_name']] = variables
+            self.form_variables.setdefault(field['form_name'], list()).extend(variables)
+        for form, variables in self.form_variables.items():
+            variables.append(form + '_complete')
+
+    def import_records(self, records):
+        now = datetime.now()
+        count = 0
+        for record in records:
+            record_id = str(record[self.key])
+            self.records.setdefault(record_id, dict()).update(record)
+            self.changed[record_id] = now
+            count += 1
+        return count
+
+    # Made up contents of a file upload field, the same every time for the same record, field and file name
+    def export_file(self, record_id, field):
+        name = self.records.get(record_id, dict()).get(field)
+        if not name:
+            return None, None
+        rand = random.Random(record_id + "|" + field + "|" + name)
+        return name, rand.randbytes(rand.randint(0, STANDIN_FILE_SIZE))
+
+    def export_records(self, record_ids, fields, forms, date_begin):
+        variables = None
+        if len(fields) > 0 or len(forms) > 0:
+            variables = [self.key]
+            for field in fields:
+                variables += self.field_variables.get(field, [field])
+            for form in forms:
+                variables += [var for var in self.form_variables.get(form, list()) if var != self.key]
+            variables = set(variables)
+
+        for record_id in (record_ids if len(record_ids) > 0 else list(self.records)):
+            record = self.records.get(record_id)
+            if record is None or (date_begin is not None and self.changed[record_id] < date_begin):
+                continue
+            yield record if variables is None else dict((var, record[var]) for var in record if var in variables)
+
+
+# Values of an array parameter, sent by PyCap as name[0], name[1], ...
+def array_param(payload, name):
+    values = list()
+    while name + "[" + str(len(values)) + "]" in payload:
+        values.append(payload[name + "[" + str(len(values)) + "]"])
+    return values
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = dict((name, values[0]) for name, values in
+                       parse_qs(self.rfile.read(length).decode('utf-8'), keep_blank_values=True).items())
+        project = self.server.project
+        content = payload.get('content')
+
+        if content == 'metadata':
+            self.respond(200, project.metadata)
+        elif content == 'version':
+            self.respond(200, STANDIN_VERSION)
+        elif content in ['event', 'arm']:
+            self.respond(400, {'error': 'You cannot export ' + content + 's for classic projects'})
+        elif content == 'file' and payload.get('action') == 'export':
+            name, contents = project.export_file(payload.get('record', ''), payload.get('field', ''))
+            if name is None:
+                self.respond(400, {'error': 'There is no file to download for this record'})
+            else:
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream; name="' + name + '"')
+                self.send_header('Content-Length', str(len(contents)))
+                self.end_headers()
+                self.wfile.write(contents)
+        elif content == 'record' and 'data' in payload:
+            self.respond(200, {'count': project.import_records(json.loads(payload['data']))})
+        elif content == 'record':
+            date_begin = None
+            if payload.get('dateRangeBegin'):
+                date_begin = datetime.strptime(payload['dateRangeBegin'], '%Y-%m-%d %H:%M:%S')
+            records = list(project.export_records(array_param(payload, 'records'), array_param(payload, 'fields'),
+                                                  array_param(payload, 'forms'), date_begin))
+            if payload.get('format') == 'csv':
+                self.respond_csv(records)
+            else:
+                self.respond(200, records)
+        else:
+            self.respond(400, {'error': 'The stand-in does not implement content ' + str(content)})
+
+    def respond(self, status, body):
+        body = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def respond_csv(self, records):
+        out = io.StringIO()
+        if len(records) > 0:
+            writer = csv.DictWriter(out, fieldnames=list(records[0]))
+            writer.writeheader()
+            writer.writerows(records)
+        self.respond(200, out.getvalue())
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve a project until the process is stopped
+def serve(metadata, records, host='127.0.0.1', port=0, ready=None):
+    """
+    :param metadata: metadata of the project
+    :param records: records of the project
+    :param host: address to listen on
+    :param port: port to listen on, 0 picks a free port
+    :param ready: optional queue the url of the API is put on once the server is listening
+    """
+
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.project = StandInProject(metadata, records)
+    if ready is not None:
+        ready.put('http://' + host + ':' + str(server.server_address[1]) + '/api/')
+    server.serve_forever()
+
+
+# Serve a synthetic project, so the records are only ever held by the stand-in's process
+def serve_synthetic(ready, port=0, records=1000, **project_args):
+    metadata = make_metadata(**project_args)
+    serve(metadata, make_records(metadata, records), port=port, ready=ready)
+
+
+if __name__ == '__main__':
+    serve_synthetic(None, port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080,
+                    records=int(sys.argv[2]) if len(sys.argv) > 2 else 1000,
+                    forms=int(sys.argv[3]) if len(sys.argv) > 3 else 5)
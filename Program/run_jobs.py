@@ -0,0 +1,156 @@
+"""
+Run the transfers listed in a job manifest, several at once and without prompts
+
+python run_jobs.py manifest.json (or manifest.yaml, if PyYAML is installed)
+
+{
+    "workers": 4,
+    "jobs": [
+        {"direction": "to_mysql", "project": "(project name)", "database": "(database name)",
+         "forms": ["(form)"], "overwrite": "skip", "options": {"chunk_size": 1000}},
+        {"direction": "to_redcap", "project": "(project name)", "database": "(database name)",
+         "tables": {"(table)": "(form)"}, "rename": false}
+    ]
+}
+
+Projects and databases are looked up in passwords.py. "forms" is optional and defaults to every form. "overwrite"
+is 'skip', 'overwrite' or 'incremental' for tables that already exist. "options" are passed on to the transfer.
+Jobs loading the same project into several databases can share one export with "options": {"cache": true}.
+If the manifest has a "metrics_dir", each job writes (name).json and a Prometheus textfile (name).prom there.
+"""
+
+import json
+import os
+import re
+import sys
+import time
+import MySQL_to_REDCap_Transfer
+import REDCap_to_MySQL_Transfer
+from concurrent.futures import ThreadPoolExecutor
+from mysql_pool import connector
+from passwords import valid_mysql, valid_redcap, REDCap_Projects
+from redcap import Project
+from transfer_metrics import TransferMetrics
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# Number of jobs run at once, unless the manifest says otherwise
+JOB_WORKERS = 4
+
+# Directions a job can transfer in
+DIRECTIONS = ['to_mysql', 'to_redcap']
+
+
+# Read a job manifest from a JSON or YAML file
+def load_manifest(path):
+    with open(path) as manifest:
+        if path.endswith('.yaml') or path.endswith('.yml'):
+            if yaml is None:
+                raise ValueError("PyYAML is needed to read '" + path + "', or use a JSON manifest")
+            return yaml.safe_load(manifest)
+        return json.load(manifest)
+
+
+# Run one job, returns dictionary mapping each table or form transferred to its number of rows
+def run_job(job, metrics=None):
+    direction = job.get('direction')
+    if direction not in DIRECTIONS:
+        raise ValueError("Unknown direction '" + str(direction) + "'")
+    if not valid_redcap(job.get('project')):
+        raise ValueError("Do not recognize REDCap project '" + str(job.get('project')) + "'")
+    if not valid_mysql(job.get('database')):
+        raise ValueError("Do not recognize MySQL database '" + str(job.get('database')) + "'")
+
+    project = Project(
+        url=REDCap_Projects[job['project']][0],
+        token=REDCap_Projects[job['project']][1],
+        name=job['project'],
+        verify_ssl=False,
+        lazy=True
+    )
+    options = dict(job.get('options', dict()))
+
+    if direction == 'to_mysql':
+        overwrite = job.get('overwrite', 'skip')
+        connect = connector(job['database'], allow_local_infile=(options.get('load_strategy') == 'infile'))
+        database = connect()
+        try:
+            return REDCap_to_MySQL_Transfer.transfer(database, project, connect=connect, forms=job.get('forms'),
+                                                     incremental=(overwrite == 'incremental'),
+                                                     overwrite_policy=None if overwrite == 'incremental' else overwrite,
+                                                     metrics=metrics, **options)
+        finally:
+            database.close()
+
+    # Tables can be given as a dictionary of table to form, or a list of [table, form]
+    tables = job.get('tables')
+    if not tables:
+        raise ValueError("A job to REDCap needs the tables to transfer")
+    transfers = list(tables.items()) if isinstance(tables, dict) else [tuple(pair) for pair in tables]
+    database = connector(job['database'])()
+    try:
+        return MySQL_to_REDCap_Transfer.transfer(database, project, transfers=transfers,
+                                                 rename=job.get('rename', False), metrics=metrics, **options)
+    finally:
+        database.close()
+
+
+# Run a job, timing it and catching its errors so the other jobs carry on
+def timed_job(job, metrics_dir=None):
+    name = job.get('name') or str(job.get('project')) + " <-> " + str(job.get('database'))
+    prefix = None
+    if metrics_dir is not None:
+        prefix = os.path.join(metrics_dir, re.sub(r'[^\w.-]+', '_', name))
+    metrics = TransferMetrics(name, prometheus_path=None if prefix is None else prefix + '.prom')
+
+    start = time.time()
+    try:
+        rows = run_job(job, metrics)
+        status = 'ok'
+    except (Exception, SystemExit) as err:
+        rows = dict()
+        status = 'failed: ' + repr(err)
+    metrics.finish()
+    if prefix is not None:
+        metrics.write_json(prefix + '.json')
+
+    return {'name': name, 'direction': job.get('direction'), 'status': status,
+            'seconds': round(time.time() - start, 1), 'rows': rows, 'metrics': metrics.report()}
+
+
+def run_jobs(manifest):
+    """
+    :param manifest: dictionary with the list of jobs, and optionally the number of workers and the metrics_dir
+    :return: list of job summaries, in the order of the manifest
+    """
+
+    jobs = manifest.get('jobs', list())
+    metrics_dir = manifest.get('metrics_dir')
+    if metrics_dir is not None:
+        os.makedirs(metrics_dir, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=manifest.get('workers', JOB_WORKERS)) as pool:
+        summaries = list(pool.map(lambda job: timed_job(job, metrics_dir), jobs))
+
+    print("\n----\n")
+    for summary in summaries:
+        print(summary['name'] + " (" + str(summary['direction']) + "): " + summary['status'] + ", " +
+              str(summary['seconds']) + "s, " + str(sum(summary['rows'].values())) + " rows")
+        targets = summary['metrics']['targets']
+        for name, rows in summary['rows'].items():
+            rate = targets.get(name, dict()).get('rows_per_second')
+            print("    " + str(name) + ": " + str(rows) + ("" if rate is None else " (" + str(rate) + " rows/s)"))
+
+    return summaries
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: python run_jobs.py manifest.json")
+        exit(1)
+
+    results = run_jobs(load_manifest(sys.argv[1]))
+    if any(result['status'] != 'ok' for result in results):
+        exit(1)
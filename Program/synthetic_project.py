@@ -0,0 +1,98 @@
+import random
+
+# Field types of the synthetic fields that are neither checkbox nor radio, with their share of those fields
+other_field_types = [('text', 0.6), ('yesno', 0.15), ('dropdown', 0.1), ('notes', 0.1), ('slider', 0.05)]
+
+words = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliett']
+
+
+# Metadata of a synthetic REDCap project
+def make_metadata(forms=5, fields_per_form=20, checkbox_density=0.2, radio_density=0.3, choices=5, seed=0,
+                  file_density=0):
+    """
+    :param forms: number of forms
+    :param fields_per_form: number of fields in each form, besides the primary key
+    :param checkbox_density: share of fields that are checkboxes
+    :param radio_density: share of fields that are radios
+    :param choices: number of choices of each checkbox, radio and dropdown field
+    :param seed: seed of the random field types
+    :param file_density: share of fields that are file uploads
+    :return: list of fields, like the metadata exported by REDCap
+    """
+
+    rand = random.Random(seed)
+    options = " | ".join(str(code) + ", Choice " + str(code) for code in range(1, choices + 1))
+
+    def field(name, form, field_type, choices_or_calculations=''):
+        return {'field_name': name, 'form_name': form, 'section_header': '', 'field_type': field_type,
+                'field_label': name, 'select_choices_or_calculations': choices_or_calculations, 'field_note': '',
+                'text_validation_type_or_show_slider_number': '', 'text_validation_min': '',
+                'text_validation_max': '', 'identifier': '', 'branching_logic': '', 'required_field': '',
+                'custom_alignment': '', 'question_number': '', 'matrix_group_name': '', 'matrix_ranking': '',
+                'field_annotation': ''}
+
+    metadata = [field('record_id', 'form_1', 'text')]
+    for form_num in range(1, forms + 1):
+        form = 'form_' + str(form_num)
+        # Each form opens with a descriptive field, which REDCap shows but never exports
+        metadata.append(field('f' + str(form_num) + '_intro', form, 'descriptive'))
+        for field_num in range(1, fields_per_form + 1):
+            name = 'f' + str(form_num) + '_' + str(field_num)
+            draw = rand.random()
+            if draw < checkbox_density:
+                metadata.append(field(name, form, 'checkbox', options))
+            elif draw < checkbox_density + radio_density:
+                metadata.append(field(name, form, 'radio', options))
+            elif draw < checkbox_density + radio_density + file_density:
+                metadata.append(field(name, form, 'file'))
+            else:
+                draw = rand.random()
+                for field_type, share in other_field_types:
+                    draw -= share
+                    if draw < 0:
+                        break
+                metadata.append(field(name, form, field_type, options if field_type == 'dropdown' else ''))
+
+    return metadata
+
+
+# Records of a synthetic REDCap project, as exported by REDCap
+def make_records(metadata, records=1000, seed=0):
+    """
+    :param metadata: metadata of the project, from make_metadata
+    :param records: number of records
+    :param seed: seed of the random values
+    :return: generator of records, each a dictionary mapping variable to value
+    """
+
+    rand = random.Random(seed)
+    key = metadata[0]['field_name']
+    forms = list()
+    for field in metadata:
+        if field['form_name'] not in forms:
+            forms.append(field['form_name'])
+
+    for record_num in range(1, records + 1):
+        record = {key: str(record_num)}
+        for field in metadata[1:]:
+            field_type = field['field_type']
+            if field_type == 'descriptive':
+                continue
+            codes = [option.split(",")[0].strip() for option in field['select_choices_or_calculations'].split("|")]
+            if field_type == 'checkbox':
+                for code in codes:
+                    record[field['field_name'] + "___" + code] = rand.choice(['0', '1'])
+            elif field_type in ['radio', 'dropdown']:
+                record[field['field_name']] = rand.choice(codes + [''])
+            elif field_type == 'yesno':
+                record[field['field_name']] = rand.choice(['0', '1', ''])
+            elif field_type == 'slider':
+                record[field['field_name']] = str(rand.randint(0, 100))
+            elif field_type == 'file':
+                # The export holds the name of the uploaded file, its contents are made up by the stand-in
+                record[field['field_name']] = rand.choice([field['field_name'] + "_" + str(record_num) + ".bin", ''])
+            else:
+                record[field['field_name']] = " ".join(rand.choice(words) for _ in range(rand.randint(0, 8)))
+        for form in forms:
+            record[form + '_complete'] = rand.choice(['0', '1', '2'])
+        yield record
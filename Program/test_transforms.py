@@ -0,0 +1,58 @@
+import csv
+import unittest
+from io import StringIO
+from REDCap_to_MySQL_Transfer import RecordBatch, add_all_indices, compile_decoder, frame_read_args, pandas
+from project_schema import ProjectSchema
+from synthetic_project import make_metadata, make_records
+
+
+# Connection and cursor keeping the rows inserted, in place of a mysql database
+class RowsWritten:
+    def __init__(self):
+        self.rows = []
+        self.statement = None
+
+    def cursor(self):
+        return self
+
+    def executemany(self, statement, rows):
+        self.statement = statement
+        self.rows += rows
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+# Rows written to a table by add_all_indices from some records of a form
+def write_rows(records, schema, form, batch_size):
+    variables = schema.form_variables[form]
+    data = RowsWritten()
+    add_all_indices(data, data, form, records, variables, schema.key, compile_decoder(schema, variables), batch_size,
+                    show_progress=False)
+    return data.rows
+
+
+class TestTransforms(unittest.TestCase):
+    @unittest.skipIf(pandas is None, "pandas is needed for the dataframe transform")
+    def test_dataframe_rows_match_record_rows(self):
+        metadata = make_metadata(forms=2, fields_per_form=30)
+        schema = ProjectSchema(metadata, 'digest')
+        records = list(make_records(metadata, 50))
+        out = StringIO()
+        writer = csv.DictWriter(out, fieldnames=list(records[0]))
+        writer.writeheader()
+        writer.writerows(records)
+
+        # A batch size that does not divide the records, so batches of a frame are decoded apart
+        for form in schema.forms:
+            expected = write_rows(RecordBatch.from_csv(out.getvalue()), schema, form, 7)
+            frame = pandas.read_csv(StringIO(out.getvalue()), **frame_read_args)
+            self.assertEqual(write_rows(frame, schema, form, 7), expected)
+            self.assertEqual(len(expected), 50)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,55 @@
-import mysql.connector
 from REDCap_to_MySQL_Transfer import transfer
-from passwords import valid_mysql, valid_redcap, REDCap_Projects, Mysql_Tables
+from passwords import valid_mysql, valid_redcap, REDCap_Projects
+from mysql_pool import connector
 from redcap import Project
+from transfer_metrics import TransferMetrics
+from transfer_profile import profiled
+from contextlib import nullcontext
+import sys
 
 REDCAP_EXPORTED_PROJECT = ''
 MYSQL_IMPORTED_DATABASE = ''
 
+# Number of records exported from REDCap and written at a time, None exports the whole project at once
+EXPORT_CHUNK_SIZE = None
+
+# Keep existing tables and only upsert records changed since the last sync, instead of asking to overwrite
+INCREMENTAL = False
+
+# Number of tables written at once, each on its own connection, less than mysql_pool.POOL_SIZE
+WORKERS = 1
+
+# How rows are written to mysql: 'insert' for batched INSERT statements, 'infile' for LOAD DATA LOCAL INFILE
+LOAD_STRATEGY = 'insert'
+
+# How records are decoded: 'rows' cell by cell, 'dataframe' a column at a time from a DataFrame export (needs pandas)
+TRANSFORM = 'rows'
+
+# Fields given a secondary index in the tables created, for the columns reports filter and join on
+INDEXES = []
+
+# Keep tables an interrupted transfer left unfinished and carry on from the last record committed to each
+RESUME = False
+
+# Number of chunks exported from REDCap at once when EXPORT_CHUNK_SIZE is set, more than 1 needs aiohttp
+API_CONCURRENCY = 1
+
+# Keep the whole export in a local Parquet file, loading other databases from it while no record has changed
+# (needs pandas and pyarrow, and EXPORT_CHUNK_SIZE = None)
+EXPORT_CACHE = False
+
+# Copy the files uploaded to file fields into the redcap_file table, only files that changed since the last copy
+TRANSFER_FILES = False
+
+# Files the timings and throughput of the transfer are written to, None writes no file. The Prometheus textfile is
+# kept current during the transfer, for node_exporter's textfile collector
+METRICS_JSON = None
+METRICS_PROMETHEUS = None
+
+# Profile the CPU time and memory of the transfer, also turned on by running with --profile. A report of each run is
+# written to transfer_profile.PROFILE_DIR
+PROFILE = '--profile' in sys.argv
+
 
 if not (valid_redcap(REDCAP_EXPORTED_PROJECT) and valid_mysql(MYSQL_IMPORTED_DATABASE)):
     if not valid_mysql(MYSQL_IMPORTED_DATABASE):
@@ -23,26 +67,28 @@ else:
     project = Project(
         url=URL,
         token=TOKEN,
-        verify_ssl=False
+        name=REDCAP_EXPORTED_PROJECT,
+        verify_ssl=False,
+        # Metadata is downloaded when the transfer loads the project schema, unless a recent one is cached
+        lazy=True
     )
     print("Done")
 
     # MySQL Database
     print("Loading MySQL Database '" + MYSQL_IMPORTED_DATABASE + "' ...")
 
-    USER = Mysql_Tables[MYSQL_IMPORTED_DATABASE][0]
-    PASSWORD = Mysql_Tables[MYSQL_IMPORTED_DATABASE][1]
-    HOST = Mysql_Tables[MYSQL_IMPORTED_DATABASE][2]
-
-    database = mysql.connector.connect(
-        user=USER,
-        password=PASSWORD,
-        host=HOST,
-        database=MYSQL_IMPORTED_DATABASE,
-        buffered=True
-    )
+    # Connections come from a pool kept open for the whole run, closing one gives it back
+    connect = connector(MYSQL_IMPORTED_DATABASE, allow_local_infile=(LOAD_STRATEGY == 'infile'))
+    database = connect()
     print("Done\n----\n")
 
     # Transfer
-    transfer(database, project)
+    metrics = TransferMetrics(REDCAP_EXPORTED_PROJECT, prometheus_path=METRICS_PROMETHEUS)
+    with profiled(REDCAP_EXPORTED_PROJECT, metrics) if PROFILE else nullcontext():
+        transfer(database, project, chunk_size=EXPORT_CHUNK_SIZE, incremental=INCREMENTAL, workers=WORKERS,
+                 connect=connect, load_strategy=LOAD_STRATEGY, metrics=metrics, transform=TRANSFORM,
+                 indexes=INDEXES, resume=RESUME, concurrency=API_CONCURRENCY, cache=EXPORT_CACHE,
+                 files=TRANSFER_FILES)
+    if METRICS_JSON is not None:
+        metrics.write_json(METRICS_JSON)
     database.close()
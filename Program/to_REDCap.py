@@ -1,11 +1,31 @@
 from MySQL_to_REDCap_Transfer import transfer
-from passwords import valid_mysql, valid_redcap, REDCap_Projects, Mysql_Tables
+from mysql_pool import connector
+from passwords import valid_mysql, valid_redcap, REDCap_Projects
 from redcap import Project
-import mysql.connector
+from transfer_metrics import TransferMetrics
+from transfer_profile import profiled
+from contextlib import nullcontext
+import sys
 
 MYSQL_EXPORTED_DATABASE = ''
 REDCAP_IMPORTED_PROJECT = ''
 
+# Files the timings and throughput of the transfer are written to, None writes no file. The Prometheus textfile is
+# kept current during the transfer, for node_exporter's textfile collector
+METRICS_JSON = None
+METRICS_PROMETHEUS = None
+
+# Only import rows new or changed since the last run, and list rows imported before that are gone from the table
+CHANGED_ONLY = False
+REPORT_DELETED = False
+
+# Number of chunks imported to REDCap at once, more than 1 needs aiohttp
+API_CONCURRENCY = 1
+
+# Profile the CPU time and memory of the transfer, also turned on by running with --profile. A report of each run is
+# written to transfer_profile.PROFILE_DIR
+PROFILE = '--profile' in sys.argv
+
 
 if not (valid_redcap(REDCAP_IMPORTED_PROJECT) and valid_mysql(MYSQL_EXPORTED_DATABASE)):
     print("Do not recognize MySQL database") if not valid_mysql(MYSQL_EXPORTED_DATABASE) else \
@@ -21,26 +41,24 @@ else:
     project = Project(
         url=URL,
         token=TOKEN,
-        verify_ssl=False
+        name=REDCAP_IMPORTED_PROJECT,
+        verify_ssl=False,
+        # Metadata is downloaded when the transfer loads the project schema, unless a recent one is cached
+        lazy=True
     )
     print("Done")
 
     # MySQL Database
     print("Loading MySQL Database '" + MYSQL_EXPORTED_DATABASE + "'")
 
-    USER = Mysql_Tables[MYSQL_EXPORTED_DATABASE][0]
-    PASSWORD = Mysql_Tables[MYSQL_EXPORTED_DATABASE][1]
-    HOST = Mysql_Tables[MYSQL_EXPORTED_DATABASE][2]
-
-    database = mysql.connector.connect(
-        user=USER,
-        password=PASSWORD,
-        host=HOST,
-        database=MYSQL_EXPORTED_DATABASE,
-        buffered=True
-    )
+    database = connector(MYSQL_EXPORTED_DATABASE)()
     print("Done\n\n----\n")
 
     # Transfer
-    transfer(database, project)
+    metrics = TransferMetrics(REDCAP_IMPORTED_PROJECT, prometheus_path=METRICS_PROMETHEUS)
+    with profiled(REDCAP_IMPORTED_PROJECT, metrics) if PROFILE else nullcontext():
+        transfer(database, project, metrics=metrics, changed_only=CHANGED_ONLY, report_deleted=REPORT_DELETED,
+                 concurrency=API_CONCURRENCY)
+    if METRICS_JSON is not None:
+        metrics.write_json(METRICS_JSON)
     database.close()
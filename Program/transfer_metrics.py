@@ -0,0 +1,174 @@
+import json
+import os
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from redcap import request as redcap_request
+
+# Seconds between progress lines of a table, and between rewrites of the Prometheus textfile during a transfer
+PROGRESS_INTERVAL = 5
+
+# Metrics of the transfer running on each thread, bytes sent to and received from REDCap are counted against it
+active = threading.local()
+
+
+# Count the bytes of every REDCap API call, PyCap sends all its requests through one requests session
+def count_api_bytes(response, *args, **kwargs):
+    metrics = getattr(active, 'metrics', None)
+    if metrics is not None:
+        metrics.add('api_bytes_sent', len(response.request.body or ''))
+        metrics.add('api_bytes_received', len(response.content))
+
+
+redcap_request._session.hooks['response'].append(count_api_bytes)
+
+
+# Timers and counters of one transfer run, per stage and per form or table
+class TransferMetrics:
+    def __init__(self, name='', prometheus_path=None):
+        """
+        :param name: name of the run, the job label in Prometheus
+        :param prometheus_path: if given, a Prometheus textfile kept current while the transfer runs
+        """
+
+        self.name = name
+        self.prometheus_path = prometheus_path
+        self.started = time.time()
+        self.finished = None
+        self.last_progress = self.started
+        # Seconds spent in each (stage, target) and value of each (counter, target), '' is the whole run
+        self.seconds = dict()
+        self.counts = dict()
+        # Peak bytes allocated during each stage, and the allocations when the most memory was held at the end of a
+        # stage, only while memory is traced by transfer_profile
+        self.memory = dict()
+        self.largest_memory = 0
+        self.memory_snapshot = None
+        self.lock = threading.Lock()
+        self.printed = dict()
+        self.flushed = 0
+
+    # Count REDCap API bytes of the calling thread against this run
+    def activate(self):
+        active.metrics = self
+
+    @contextmanager
+    def timer(self, stage, target=''):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start, target)
+            if tracing and tracemalloc.is_tracing():
+                self.trace_memory(stage)
+
+    def trace_memory(self, stage):
+        current, peak = tracemalloc.get_traced_memory()
+        with self.lock:
+            self.memory[stage] = max(self.memory.get(stage, 0), peak)
+            largest = current > self.largest_memory
+            if largest:
+                self.largest_memory = current
+        if largest:
+            self.memory_snapshot = tracemalloc.take_snapshot()
+
+    def add_time(self, stage, seconds, target=''):
+        with self.lock:
+            self.seconds[(stage, target)] = self.seconds.get((stage, target), 0) + seconds
+
+    def add(self, counter, value, target=''):
+        with self.lock:
+            self.counts[(counter, target)] = self.counts.get((counter, target), 0) + value
+
+    # Show how far a target has got, at most every PROGRESS_INTERVAL seconds unless it is done
+    def progress(self, target, done, total=None):
+        now = time.time()
+        with self.lock:
+            self.last_progress = now
+            if (total is None or done < total) and now - self.printed.get(target, 0) < PROGRESS_INTERVAL:
+                return
+            self.printed[target] = now
+            # Rate over the time spent on the target, or over the whole run if nothing is timed against it
+            busy = sum(seconds for (_, timed), seconds in self.seconds.items() if timed == target)
+
+        busy = busy or now - self.started
+        line = str(target) + ": " + str(done) + ("" if total is None else " of " + str(total))
+        if busy > 0:
+            line += " (" + str(int(done / busy)) + " per second)"
+        print(line)
+
+        if self.prometheus_path is not None and now - self.flushed >= PROGRESS_INTERVAL:
+            self.flushed = now
+            self.write_prometheus(self.prometheus_path)
+
+    def finish(self):
+        self.finished = time.time()
+        if self.prometheus_path is not None:
+            self.write_prometheus(self.prometheus_path)
+
+    def report(self):
+        """
+        :return: dictionary of the run: its times, and the seconds per stage, counters and rows/s of each target
+        """
+
+        with self.lock:
+            seconds = dict(self.seconds)
+            counts = dict(self.counts)
+        elapsed = (self.finished or time.time()) - self.started
+
+        targets = dict()
+        for (name, target), value in list(seconds.items()) + list(counts.items()):
+            entry = targets.setdefault(target, {'seconds': dict(), 'counts': dict()})
+            entry['seconds' if (name, target) in seconds else 'counts'][name] = round(value, 6)
+
+        # Rows per second of a table is over the time spent on it, of the whole run over the elapsed time
+        for target, entry in targets.items():
+            busy = sum(entry['seconds'].values()) if target != '' else elapsed
+            rows = entry['counts'].get('rows', 0) if target != '' else sum(
+                value for (name, _), value in counts.items() if name == 'rows')
+            entry['rows_per_second'] = round(rows / busy, 1) if busy > 0 else None
+
+        return {'name': self.name,
+                'started': datetime.fromtimestamp(self.started).isoformat(),
+                'finished': datetime.fromtimestamp(self.finished).isoformat() if self.finished else None,
+                'elapsed_seconds': round(elapsed, 3),
+                'targets': targets}
+
+    def write_json(self, path):
+        write_file(path, json.dumps(self.report(), indent=2))
+
+    def prometheus_lines(self):
+        job = {'job': self.name}
+        lines = [metric_line('ycmi_started_timestamp_seconds', job, self.started),
+                 metric_line('ycmi_last_progress_timestamp_seconds', job, self.last_progress),
+                 metric_line('ycmi_finished_timestamp_seconds', job, self.finished or 0)]
+        with self.lock:
+            for (stage, target), value in sorted(self.seconds.items()):
+                lines.append(metric_line('ycmi_stage_seconds', dict(job, stage=stage, target=target), value))
+            for (counter, target), value in sorted(self.counts.items()):
+                lines.append(metric_line('ycmi_' + re.sub(r'\W', '_', counter) + '_total',
+                                         dict(job, target=target), value))
+        return lines
+
+    def write_prometheus(self, path):
+        write_file(path, "\n".join(self.prometheus_lines()) + "\n")
+
+
+# One sample in the Prometheus text format
+def metric_line(name, labels, value):
+    escaped = [key + '="' + str(label).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, label in labels.items()]
+    return name + "{" + ",".join(escaped) + "} " + repr(float(value))
+
+
+# Write a file so readers never see it half written
+def write_file(path, text):
+    with open(path + '.tmp', 'w') as out:
+        out.write(text)
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,96 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# Directory the profile of each run is written to
+PROFILE_DIR = 'profiles'
+
+# Number of functions listed by cumulative time, and of lines listed by memory allocated
+PROFILE_TOP = 40
+ALLOCATION_TOP = 25
+
+# Frames kept for each allocation, more show who called the allocating line but slow the run down further
+TRACEMALLOC_FRAMES = 1
+
+
+# Profile the CPU time and memory of what runs inside, writing a report and a pstats file when it is done
+@contextmanager
+def profiled(name, metrics=None, directory=PROFILE_DIR):
+    """
+    :param name: name of the run, the files written are (name)-(time).txt and (name)-(time).prof
+    :param metrics: optional TransferMetrics of the run, its stages' times and peak memory are added to the report
+    :param directory: directory the files are written to
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, re.sub(r'[^\w.-]+', '_', name or 'transfer') + "-" +
+                        datetime.now().strftime('%Y%m%d-%H%M%S'))
+
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        profiler.dump_stats(path + '.prof')
+        with open(path + '.txt', 'w') as report:
+            report.write(profile_report(name, profiler, snapshot, current, peak, metrics))
+        print("Profile written to '" + path + ".txt'")
+
+
+# Text of the profile: memory, memory and time of each stage, functions by cumulative time, allocations by line
+def profile_report(name, profiler, snapshot, current, peak, metrics=None):
+    lines = ["Profile of '" + str(name) + "', " + datetime.now().isoformat(timespec='seconds'), ""]
+
+    stage_peaks = dict()
+    stage_seconds = dict()
+    if metrics is not None:
+        stage_peaks = dict(metrics.memory)
+        for (stage, _), seconds in metrics.seconds.items():
+            stage_seconds[stage] = stage_seconds.get(stage, 0) + seconds
+
+    # The peak is reset at the start of each stage, so the run's peak is the largest of them
+    lines.append("Peak memory: " + megabytes(max([peak] + list(stage_peaks.values()))))
+    lines.append("Memory at the end: " + megabytes(current))
+    lines.append("")
+
+    if len(stage_seconds) > 0:
+        lines.append("Stage            seconds   peak memory")
+        for stage in sorted(stage_seconds, key=stage_seconds.get, reverse=True):
+            lines.append(stage.ljust(15) + str(round(stage_seconds[stage], 3)).rjust(9) +
+                         (megabytes(stage_peaks[stage]) if stage in stage_peaks else "-").rjust(14))
+        lines.append("Only the main thread is profiled, stages on workers count towards their own peak only")
+        lines.append("")
+
+    lines.append("Top " + str(PROFILE_TOP) + " functions by cumulative time")
+    stats = io.StringIO()
+    pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(PROFILE_TOP)
+    lines.append(stats.getvalue().strip())
+    lines.append("")
+
+    # Allocations are listed from the end of the stage that left the most memory allocated, if more than at the end
+    if metrics is not None and metrics.memory_snapshot is not None and metrics.largest_memory > current:
+        lines.append("Top " + str(ALLOCATION_TOP) + " lines by memory allocated, at the end of the stage holding the "
+                     "most (" + megabytes(metrics.largest_memory) + ")")
+        snapshot = metrics.memory_snapshot
+    else:
+        lines.append("Top " + str(ALLOCATION_TOP) + " lines by memory allocated at the end")
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    for statistic in snapshot.statistics('lineno')[:ALLOCATION_TOP]:
+        lines.append(str(statistic))
+
+    return "\n".join(lines) + "\n"
+
+
+def megabytes(size):
+    return str(round(size / 2 ** 20, 1)) + " MB"